@@ -1,5 +1,7 @@
 # A class to compute the AFAI index
 
+import numpy as np
+
 from Sargassum_Index import Sargassum_Index
 
 # ==============================================================================
@@ -19,6 +21,9 @@ class AFAI_Index(Sargassum_Index):
     "SWIR": {"ch": "B8A", "lambda": 865.}   # ~ MODIS 869
   }
 
+  # Weight of SWIR in the linear interpolation of the NIR baseline
+  K = (meta_channels["NIR"]["lambda"] - meta_channels["RED"]["lambda"]) / (meta_channels["SWIR"]["lambda"] - meta_channels["RED"]["lambda"])
+
   # ----------------------------------------------------------------------------
 
   def __init__(self, verbose=True):
@@ -32,15 +37,16 @@ class AFAI_Index(Sargassum_Index):
     NIR = channels_data[self.meta_channels["NIR"]["ch"]]
     SWIR = channels_data[self.meta_channels["SWIR"]["ch"]]
 
-    RED_lambda = self.meta_channels["RED"]["lambda"]
-    NIR_lambda = self.meta_channels["NIR"]["lambda"]
-    SWIR_lambda = self.meta_channels["SWIR"]["lambda"]
-
-    R_NIR_prime = RED + (SWIR - RED) * (NIR_lambda - RED_lambda)/(SWIR_lambda - RED_lambda)
-
-    AFAI = NIR - R_NIR_prime
+    # AFAI = NIR - R_NIR_prime, with the baseline R_NIR_prime = RED + (SWIR -
+    # RED) * K; computed in place on a single output array to avoid
+    # allocating a temporary per operation. The output is always float32, so
+    # channels loaded as float16 are upcast on the fly as they're read
+    AFAI = np.subtract(SWIR, RED, dtype="float32")
+    AFAI *= self.K
+    AFAI += RED
+    np.subtract(NIR, AFAI, out=AFAI)
 
-    if self.verbose:
+    if self.verbose and AFAI.size > 0:
       print("Min: {}".format(AFAI.min()))
       print("Max: {}".format(AFAI.max()))
 
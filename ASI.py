@@ -2,13 +2,19 @@
 
 # ==============================================================================
 
+import concurrent.futures
 import datetime
+import json
 import os
 import sys
 import time
 
 import numpy as np
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+# oneDNN/OpenMP settings are only read when tensorflow is imported
+os.environ.setdefault('TF_ENABLE_ONEDNN_OPTS', '1')
+os.environ.setdefault('KMP_BLOCKTIME', '0')
+os.environ.setdefault('OMP_NUM_THREADS', str(os.cpu_count()))
 import tensorflow as tf
 from tensorflow import keras
 
@@ -38,19 +44,64 @@ class ASI_Index(Sargassum_Index):
 
   # ============================================================================
 
-  def __init__(self, model_path=None, verbose=True):
+  def __init__(self, model_path=None, batch_size=2048, backend="keras", num_threads=None, cache_savedmodel=False, verbose=True):
     """Can optionally define the path to a model so it's loaded at instance
-    construction"""
+    construction.
+
+    The batch_size (default: 2048) is the number of pixels that compute()
+    sends through the model at once; it can be large when predicting.
+
+    The backend (default: "keras") selects how compute() evaluates the model:
+    "keras" runs it through TensorFlow, while "numpy" evaluates its Dense
+    layers directly as matrix products, which avoids all TensorFlow overhead
+    for the small ASI networks.
+
+    The num_threads (default: None, i.e. all CPUs) sets the size of the
+    TensorFlow thread pool used within operations; this can only be done
+    before TensorFlow executes anything, so an ASI_Index should be created
+    before any other TensorFlow work in the program.
+
+    The cache_savedmodel option (default: False) is passed to load_model()."""
+
+    if backend not in ["keras", "numpy"]:
+      raise ValueError("Unknown ASI backend '{}'; must be 'keras' or 'numpy'".format(backend))
 
     self.verbose = verbose
+    self.batch_size = batch_size
+    self.backend = backend
     self.model_path = None
     self.model = None
+    self._predict_fn = None
+    self._dense_layers = None
+    self._configure_tf_threads(num_threads)
     if model_path is not None:
-      self.load_model(model_path)
+      self.load_model(model_path, cache_savedmodel=cache_savedmodel)
+
+  # ============================================================================
+
+  def _configure_tf_threads(self, num_threads=None):
+    """Sizes TensorFlow's thread pools: num_threads (default: all CPUs) for
+    intra-op parallelism and a single inter-op thread, since the ASI networks
+    are a plain sequence of layers and competing inter-op threads only add
+    contention."""
+
+    if num_threads is None:
+      num_threads = os.cpu_count()
+
+    threading = tf.config.threading
+    if threading.get_intra_op_parallelism_threads() == num_threads and threading.get_inter_op_parallelism_threads() == 1:
+      return
+
+    try:
+      threading.set_intra_op_parallelism_threads(num_threads)
+      threading.set_inter_op_parallelism_threads(1)
+    except RuntimeError:
+      if self.verbose:
+        print("Warning: TensorFlow already initialized; can't configure its thread pools")
 
   # ============================================================================
 
-  def compute(self, channels_data, batch_size=2048):
+  def compute(self, channels_data, batch_size=None, chunk_size=2**20):
     """Computes the ASI index from a dataset previously loaded by  Sentinel2.load_channels()
 
     Parameters:
@@ -61,70 +112,213 @@ class ASI_Index(Sargassum_Index):
 
     Options:
 
-      batch_size : integer (default: 2048)
-        The batch size to use in the prediction (passed to keras)
+      batch_size : integer (default: None)
+        The batch size to use in the prediction (passed to keras); if None,
+        the batch_size given at instance construction is used
+
+      chunk_size : integer (default: 2**20)
+        The number of pixels packed into the model input at a time; the image
+        is streamed through the model in chunks of this size, so that memory
+        use doesn't grow with the size of the image
 
     Returns:
 
       A numpy array of same shape as the channels with the result of the
       ASI predictions, which are numbers in [0, 1] interpreted as the
-      probability that each pixel contains sargassum.
+      probability that each pixel contains sargassum. Pixels with no data
+      (zero in all channels) are not predicted and are set to 0.
     """
 
     assert self.required_channels is not None
 
-    NCH = len(channels_data)
-    NX, NY = channels_data[self.required_channels[0]].shape
-    NTOT = NX * NY
-    dtype = channels_data[self.required_channels[0]].dtype
-
-    # Join and reshape data in preparation for keras
-    data = np.empty((NTOT, NCH), dtype=dtype)
-    for i in range(NCH):
-      data[:, i] = channels_data[self.required_channels[i]].reshape((NTOT,))
+    if batch_size is None:
+      batch_size = self.batch_size
+
+    NCH = len(self.required_channels)
+    shape = channels_data[self.required_channels[0]].shape
+    NTOT = channels_data[self.required_channels[0]].size
+    chunk_size = max(1, min(chunk_size, NTOT))
+
+    # Flat views of the channels; the input for keras is packed from these
+    # one chunk at a time into two staging buffers, used alternately so that
+    # the next chunk is packed while the current one is being predicted. The
+    # models take float32, so channels loaded with a smaller dtype are upcast
+    # in the copy
+    channels = [channels_data[ch].reshape((NTOT,)) for ch in self.required_channels]
+    stages = [np.empty((chunk_size, NCH), dtype="float32") for i in range(2)]
     if self.verbose:
-      print("Input: {:,} x {}, {:.1f} MB".format(*data.shape, data.nbytes/1024**2))
+      print("Input: {:,} x {}, streamed in chunks of {:,} pixels ({:.1f} MB)".format(NTOT, NCH, chunk_size, stages[0].nbytes/1024**2))
 
     if self.verbose:
       GPUs = tf.config.experimental.list_physical_devices('GPU')
-      if len(GPUs) > 0:
+      if self.backend == "numpy":
+        s = "Executing on CPU (numpy)"
+      elif len(GPUs) > 0:
         s = "Executing on {} GPU{}".format(len(GPUs), "s" if len(GPUs) > 1 else "", GPUs)
       else:
         s = "Executing on CPU"
       s += " using batch_size = {}".format(batch_size)
       print(s)
 
-    # Run through model
-    result = self.model.predict(data, verbose=self.verbose, batch_size=batch_size)
-
-    # Reshape result back to original image shape
-    result = result.reshape((NX, NY))
+    # Run through model, one chunk and one batch at a time; predictions are
+    # written into a flat view of the image-shaped result
+    result = np.empty(shape, dtype="float32")
+    result_flat = result.reshape((NTOT,))
+    # The compiled model is only ever given full batches, since XLA compiles
+    # it again for every new input shape: a smaller last batch of a chunk is
+    # padded up to batch_size in this buffer
+    if self.backend != "numpy":
+      tail = np.zeros((batch_size, NCH), dtype="float32")
+    chunk_starts = list(range(0, NTOT, chunk_size))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as packer:
+
+      packed = packer.submit(self._pack_chunk, channels, stages[0], 0, chunk_size)
+
+      for k, chunk_start in enumerate(chunk_starts):
+
+        # Wait for this chunk and start packing the next one
+        X, valid = packed.result()
+        if k + 1 < len(chunk_starts):
+          packed = packer.submit(self._pack_chunk, channels, stages[(k+1) % 2], chunk_starts[k+1], chunk_size)
+
+        # Predictions go straight into the result unless some pixels were
+        # skipped, in which case they're scattered back afterwards
+        result_chunk = result_flat[chunk_start:chunk_start+(len(X) if valid is None else len(valid))]
+        pred_out = result_chunk if valid is None else np.empty(len(X), dtype="float32")
+
+        n = len(X)
+        for start in range(0, n, batch_size):
+          end = min(start + batch_size, n)
+          if self.backend == "numpy":
+            self._predict_numpy(X[start:end], out=pred_out[start:end].reshape((end - start, 1)))
+          elif end - start == batch_size:
+            pred_out[start:end] = self._predict_fn(tf.constant(X[start:end])).numpy().reshape((end - start,))
+          else:
+            tail[:end-start] = X[start:end]
+            pred_out[start:end] = self._predict_fn(tf.constant(tail)).numpy()[:end-start].reshape((end - start,))
+
+        if valid is not None:
+          result_chunk[:] = 0
+          result_chunk[valid] = pred_out
 
     return result
 
   # ============================================================================
 
-  def load_model(self, model_path):
+  def load_model(self, model_path, cache_savedmodel=False):
     """Loads an ASI model (a previously trained keras Sequential NN saved
-    as an HDF5 file
+    as an HDF5 file or as a SavedModel directory)
 
     Parameters:
 
       model_path : string
         The path to the ASI model
 
+    Options:
+
+      cache_savedmodel : boolean (default: False)
+        If True and the model is an HDF5 file, it's converted once to the
+        SavedModel format, stored next to it (with the same name ending in
+        "_savedmodel"), and the converted copy is loaded in later calls; it's
+        converted again if the HDF5 file is newer
+
     Returns:
 
       None; the model is loaded into class variable self.model
     """
 
     self.model_path = model_path
-    self.model = keras.models.load_model(self.model_path)
+
+    savedmodel_path = None
+    savedmodel_valid = False
+    if cache_savedmodel and model_path.endswith(".h5"):
+      savedmodel_path = os.path.splitext(model_path)[0] + "_savedmodel"
+      savedmodel_pb = os.path.join(savedmodel_path, "saved_model.pb")
+      savedmodel_valid = os.path.isfile(savedmodel_pb) and os.path.getmtime(savedmodel_pb) >= os.path.getmtime(model_path)
+
+    if savedmodel_valid:
+      self.model = keras.models.load_model(savedmodel_path)
+    else:
+      self.model = keras.models.load_model(self.model_path)
+      if savedmodel_path is not None:
+        self.model.save(savedmodel_path, save_format="tf")
+        if self.verbose:
+          print("Saved ASI model as {}".format(savedmodel_path))
+
+    # Trace the forward pass once, so that compute() avoids the per-call
+    # overhead of model.predict(); XLA fuses the layers into a single kernel.
+    # compute() only passes full batches, so a first call with one pays the
+    # compilation cost up front
+    if self.backend == "keras":
+      model = self.model
+      input_spec = tf.TensorSpec([None, len(self.required_channels)], tf.float32)
+      self._predict_fn = tf.function(lambda x: model(x, training=False), input_signature=[input_spec], jit_compile=True).get_concrete_function()
+      self._predict_fn(tf.zeros((self.batch_size, len(self.required_channels)), dtype=tf.float32))
+
+    # Extract the weights of the Dense layers for the numpy backend
+    else:
+      self._dense_layers = []
+      for layer in self.model.layers:
+        if isinstance(layer, keras.layers.Flatten):
+          continue
+        if not isinstance(layer, keras.layers.Dense):
+          raise ValueError("The numpy backend only supports Dense layers; found {}".format(type(layer).__name__))
+        activation = layer.activation.__name__
+        if activation not in ["linear", "relu", "sigmoid"]:
+          raise ValueError("The numpy backend doesn't support the '{}' activation".format(activation))
+        W, b = layer.get_weights()
+        self._dense_layers.append((W.astype("float32"), b.astype("float32"), activation))
     if self.verbose:
       print("Loaded ASI model {}".format(self.model_path))
 
   # ============================================================================
 
+  def _pack_chunk(self, channels, stage, chunk_start, chunk_size):
+    """Copies the pixels [chunk_start, chunk_start + chunk_size) of the flat
+    channels into the columns of the staging buffer.
+
+    Pixels where all channels are zero (no data) are dropped, as there's no
+    point in running them through the model. Returns the tuple (X, valid),
+    where X are the samples to predict and valid is a boolean array marking
+    which pixels of the chunk they are, or None if none were dropped."""
+
+    n = min(chunk_size, channels[0].size - chunk_start)
+    for i in range(len(channels)):
+      stage[:n, i] = channels[i][chunk_start:chunk_start+n]
+
+    valid = np.any(stage[:n] != 0, axis=1)
+    if valid.all():
+      return stage[:n], None
+    else:
+      return stage[:n][valid], valid
+
+  # ============================================================================
+
+  def _predict_numpy(self, X, out=None):
+    """Evaluates the loaded model on the samples X using only numpy, with one
+    matrix product per Dense layer; activations are applied in place. If
+    given, the output of the last layer is written into out, which must be a
+    C-contiguous float32 array of the right shape."""
+
+    last = len(self._dense_layers) - 1
+    for l, (W, b, activation) in enumerate(self._dense_layers):
+      X = np.dot(X, W, out=out if l == last else None)
+      X += b
+      if activation == "relu":
+        np.maximum(X, 0, out=X)
+      elif activation == "sigmoid":
+        # exp() overflows to inf for large negative inputs, which correctly
+        # gives 0 in the end, so the overflow warning is silenced
+        np.negative(X, out=X)
+        with np.errstate(over="ignore"):
+          np.exp(X, out=X)
+        X += 1
+        np.reciprocal(X, out=X)
+
+    return X
+
+  # ============================================================================
+
   def load_ML_dataset(self, dataset_path):
     """Loads a ML dataset previously created by generate_training_set().
 
@@ -139,11 +333,33 @@ class ASI_Index(Sargassum_Index):
 
       The tuple (names, x, y), where:
         names: a list with the column names in the dataset
-        X: the loaded samples
+        X: the loaded samples, as a read-only view of the memory-mapped file
+           (or in memory, for compressed .npz datasets)
         y: the loaded class labels
     """
 
-    dataset = np.load(dataset_path)
+    # Compressed training sets have the features and classes in separate
+    # arrays, and are loaded in full
+    if dataset_path.endswith(".npz"):
+
+      with np.load(dataset_path) as dataset:
+        X = dataset["X"]
+        y = dataset["y"].astype(int)
+        has_coords = "coords" in dataset
+
+      names = ['B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B8A', 'B11', 'B12', 'sargassum']
+      if has_coords:
+        names = ['coordX', 'coordY'] + names
+
+      if X.ndim == 3:
+        X = X.reshape((-1, X.shape[2]))
+        y = y.reshape((-1,))
+
+      return names, X, y
+
+    # Memory-map the dataset, so that samples are only read from disk as
+    # they're used and no full copy is made in memory
+    dataset = np.load(dataset_path, mmap_mode="r")
 
     if dataset.ndim == 2:
 
@@ -167,7 +383,7 @@ class ASI_Index(Sargassum_Index):
 
   # ============================================================================
 
-  def train_model(self, train_set_path, batch_size=32, training_epochs=10, model_out_dir="./"):
+  def train_model(self, train_set_path, batch_size=32, training_epochs=10, model_out_dir="./", mixed_precision=False, grad_accum_steps=1, num_gpus=None, jit_compile=True, steps_per_execution=1, cache_dir=None, deterministic=False, seed=0, checkpoint_epochs=None):
     """Main routine to train a new model.
 
     Parameters:
@@ -178,8 +394,12 @@ class ASI_Index(Sargassum_Index):
 
     Options:
 
-      batch_size : integer (default: 32)
-        The batch size to use in training (passed to keras)
+      batch_size : integer or "auto" (default: 32)
+        The batch size to use in training (passed to keras). If "auto", the
+        largest power of two from 32 to 512 that fits in the GPU memory is
+        used; it's found by trying them and the result is saved per GPU and
+        precision in a .bs_cache file in model_out_dir, so the search is only
+        done once. Without a GPU, "auto" means the default of 32
 
       training_epochs : integer (default: 10)
         The number of training epochs to use (passed to keras)
@@ -188,6 +408,58 @@ class ASI_Index(Sargassum_Index):
         The directory where the trained model is to be saved. The model will
         be saved as 'new_model.h5'. Defaults to the current working directory
 
+      mixed_precision : boolean (default: False)
+        Whether to train with the 'mixed_float16' Keras policy: layers compute
+        in float16 (using the Tensor Cores of recent NVIDIA GPUs) while keeping
+        float32 weights, and the loss is scaled dynamically to preserve small
+        gradients. The output layer is kept in float32. Only faster on GPUs
+
+      grad_accum_steps : integer (default: 1)
+        If larger than 1, the gradients of this many consecutive batches are
+        accumulated (averaged) before updating the weights, so the effective
+        batch size is batch_size * grad_accum_steps while the memory used per
+        step is that of batch_size
+
+      num_gpus : integer (default: None)
+        If larger than 1, the model is replicated over this many GPUs with a
+        tf.distribute.MirroredStrategy, each replica processing batch_size
+        samples per step (so the global batch size is batch_size * num_gpus).
+        Can't be combined with grad_accum_steps
+
+      jit_compile : boolean (default: True)
+        Whether to compile the training step with XLA, which fuses its many
+        small operations into a few kernels. A step is compiled once per
+        batch shape, i.e. twice in all if the last batch is smaller
+
+      steps_per_execution : integer (default: 1)
+        The number of training steps run in each call to the compiled
+        training function (passed to keras); running several at once avoids
+        the per-step dispatch overhead, which dominates with small models and
+        batches. Progress and callbacks are updated once per call
+
+      cache_dir : string (default: None)
+        If given, the training set is converted once into contiguous float32
+        features and int8 labels saved in this directory, which are memory-
+        mapped in this and later trainings on the same set (it's converted
+        again if the training set is newer). Mostly useful for compressed
+        .npz training sets, which otherwise are decompressed on every run
+
+      deterministic : boolean (default: False)
+        Whether to make training reproducible: the Python, numpy and
+        TensorFlow random generators, and the one shuffling the training
+        samples, are seeded with seed, and TensorFlow is set to use only
+        deterministic operations (which also turns off cuDNN autotuning, and
+        can be slower). This setting stays for the rest of the program
+
+      seed : integer (default: 0)
+        The random seed to use if deterministic is True
+
+      checkpoint_epochs : integer (default: None)
+        If given, the model is also saved every this many epochs, as
+        'checkpoint_epoch<N>.h5' in model_out_dir. The weights are copied at
+        the end of the epoch, but written to disk in a background thread
+        while training continues
+
     Returns:
 
       The trained model (a keras.Sequential object)
@@ -205,7 +477,10 @@ class ASI_Index(Sargassum_Index):
     # --------------------------------------------------------------------------
     # Load training set
 
-    names, X, y = self.load_ML_dataset(train_set_path)
+    if cache_dir is not None:
+      X, y = self._materialize_dataset(train_set_path, cache_dir)
+    else:
+      names, X, y = self.load_ML_dataset(train_set_path)
 
     print()
     print(train_set_path)
@@ -213,8 +488,8 @@ class ASI_Index(Sargassum_Index):
     print("y shape: " + str(y.shape))
 
     # Count classes
-    (unique, counts) = np.unique(y, return_counts=True)
-    frequencies = np.asarray((unique, counts))
+    counts = np.bincount(y, minlength=3)
+    frequencies = np.stack([np.arange(counts.size), counts])
     print(frequencies.shape)
     print(frequencies)
 
@@ -227,33 +502,74 @@ class ASI_Index(Sargassum_Index):
     print("\n"+"-"*70)
     print("Training neural network ...\n")
 
-    # Separate training and test data
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.3, random_state=0)
+    if deterministic:
+      keras.utils.set_random_seed(seed)
+      tf.config.experimental.enable_op_determinism()
+
+    # Find the largest batch size that fits in memory, if requested
+    if batch_size == "auto":
+      batch_size = self._autotune_batch_size(X, y, mixed_precision, model_out_dir)
+      print("Using batch size {}\n".format(batch_size))
+
+    # Replicate the model over several GPUs, if requested; each step's batch
+    # is split among the replicas, so the global batch size grows with them
+    if num_gpus is not None and num_gpus > 1:
+      if grad_accum_steps > 1:
+        raise ValueError("Gradient accumulation can't be combined with multiple GPUs")
+      strategy = tf.distribute.MirroredStrategy(devices=["/gpu:{}".format(i) for i in range(num_gpus)])
+      batch_size *= strategy.num_replicas_in_sync
+      print("Training on {} GPUs, global batch size {}\n".format(strategy.num_replicas_in_sync, batch_size))
+    else:
+      strategy = tf.distribute.get_strategy()
 
-    # Create neural network
-    model = keras.Sequential([
-        keras.layers.Flatten(input_shape=(9,)),
-        keras.layers.Dense(14, activation=tf.nn.relu),
-        keras.layers.Dense(1, activation=tf.nn.sigmoid),
-    ])
+    # The model and optimizer variables are created in the strategy's scope
+    with strategy.scope():
 
-    # Set optimizer and loss function
-    model.compile(optimizer='adam',
-                  loss='binary_crossentropy',
-                  metrics=['accuracy'])
+      # Create neural network
+      model = self._create_model(mixed_precision)
+
+      # With gradient accumulation the model is trained through a wrapper that
+      # does the accumulation; the model itself is unchanged and is saved alone
+      if grad_accum_steps > 1:
+        trainer = _GradientAccumulation(model, grad_accum_steps)
+      else:
+        trainer = model
+
+      # Set optimizer and loss function
+      optimizer = keras.optimizers.Adam()
+      if mixed_precision:
+        optimizer = keras.mixed_precision.LossScaleOptimizer(optimizer)
+      trainer.compile(optimizer=optimizer,
+                      loss='binary_crossentropy',
+                      metrics=['accuracy'],
+                      jit_compile=jit_compile,
+                      steps_per_execution=steps_per_execution)
+
+    # Separate training and test data; only the indices are split, and the
+    # samples are read from the (memory-mapped) dataset one batch at a time
+    # as they're fed to the model. On a single GPU the batches are copied to
+    # it ahead of time; a multi-GPU strategy distributes them itself
+    if strategy.num_replicas_in_sync == 1 and tf.config.list_physical_devices("GPU"):
+      device = "/gpu:0"
+    else:
+      device = None
+    train_idx, test_idx = train_test_split(np.arange(len(y)), test_size=0.3, random_state=0)
+    train_data = self._build_dataset(X, y, train_idx, batch_size, shuffle=True, seed=seed if deterministic else None, device=device)
+    test_data = self._build_dataset(X, y, test_idx, batch_size, device=device)
 
     # Tensorboard requirements
     log_dir = "logs/fit/" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
     tensorboard_callback = keras.callbacks.TensorBoard(log_dir=log_dir, histogram_freq=1)
+    callbacks = [tensorboard_callback]
+    if checkpoint_epochs is not None:
+      callbacks.append(_BackgroundCheckpoint(model, model_out_dir, checkpoint_epochs))
 
     # Train
-    model.fit(X_train,
-              y_train,
-              epochs=training_epochs,
-              batch_size=batch_size,
-              verbose=1,
-              validation_data=(X_test, y_test),
-              callbacks=[tensorboard_callback])
+    trainer.fit(train_data,
+                epochs=training_epochs,
+                verbose=1,
+                validation_data=test_data,
+                callbacks=callbacks)
 
     # Training time
     time_trained = time.time()
@@ -277,7 +593,229 @@ class ASI_Index(Sargassum_Index):
 
   # ============================================================================
 
-  def test_model(self, test_set_path, model_path, remove_masked=True, predict_threshold=0.5, batch_size=2048):
+  def export_tflite(self, model, train_set_path, out_dir="./", num_samples=1000, seed=0):
+    """Converts a trained model into two reduced-precision TensorFlow Lite
+    models for deployment: 'asi_fp16.tflite', with the weights stored as
+    float16 (half the size), and 'asi_int8.tflite', with the weights and
+    activations quantized to int8 (a quarter of the size) and only integer
+    kernels. The int8 quantization ranges are calibrated with samples from
+    the training set; both models keep float32 inputs and outputs, which the
+    int8 one quantizes and dequantizes at its ends.
+
+    Parameters:
+
+      model : keras.Model
+        The trained model, e.g. as returned by train_model()
+
+      train_set_path : string
+        The path to the ML dataset the model was trained with
+
+    Options:
+
+      out_dir : string (default: "./")
+        The directory where the converted models are saved
+
+      num_samples : integer (default: 1000)
+        The number of random training samples used to calibrate the int8
+        quantization
+
+      seed : integer (default: 0)
+        The random seed used to pick the calibration samples
+
+    Returns:
+
+      A dictionary with the paths of the saved models, keyed by "fp16" and
+      "int8"
+    """
+
+    names, X, y = self.load_ML_dataset(train_set_path)
+
+    rng = np.random.default_rng(seed)
+    sample_idx = np.sort(rng.choice(len(X), size=min(num_samples, len(X)), replace=False))
+    samples = X[sample_idx].astype("float32")
+
+    def representative_dataset():
+      for i in range(len(samples)):
+        yield [samples[i:i+1]]
+
+    out_paths = {}
+
+    for name in ["fp16", "int8"]:
+
+      converter = tf.lite.TFLiteConverter.from_keras_model(model)
+      converter.optimizations = [tf.lite.Optimize.DEFAULT]
+      if name == "fp16":
+        converter.target_spec.supported_types = [tf.float16]
+      else:
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+      out_path = os.path.join(out_dir, "asi_{}.tflite".format(name))
+      with open(out_path, "wb") as f:
+        f.write(converter.convert())
+      print("Saved {}".format(out_path))
+
+      out_paths[name] = out_path
+
+    return out_paths
+
+  # ============================================================================
+
+  def _create_model(self, mixed_precision=False):
+    """Creates a new (untrained) ASI neural network"""
+
+    # The precision policy applies to layers as they're created, so it's set
+    # while building the model and restored afterwards
+    prev_policy = keras.mixed_precision.global_policy()
+    if mixed_precision:
+      keras.mixed_precision.set_global_policy("mixed_float16")
+
+    # The output is computed in float32 in any case
+    model = keras.Sequential([
+        keras.layers.Flatten(input_shape=(len(self.required_channels),)),
+        keras.layers.Dense(14, activation=tf.nn.relu),
+        keras.layers.Dense(1, activation=tf.nn.sigmoid, dtype="float32"),
+    ])
+
+    keras.mixed_precision.set_global_policy(prev_policy)
+
+    return model
+
+  # ============================================================================
+
+  def _autotune_batch_size(self, X, y, mixed_precision, cache_dir, candidates=(32, 64, 128, 256, 512), default=32):
+    """Returns the largest of the candidate batch sizes with which a couple of
+    training steps run without exhausting the GPU memory. The result is saved
+    in a .bs_cache file in cache_dir for the current GPU and precision, and
+    read from there if already found.
+
+    Without a GPU the search is pointless, as memory is never exhausted in
+    time, and the default batch size is returned."""
+
+    # The device is identified by the name of the (first) GPU
+    gpus = tf.config.list_physical_devices("GPU")
+    if len(gpus) == 0:
+      return default
+    device = tf.config.experimental.get_device_details(gpus[0]).get("device_name", gpus[0].name)
+    key = "{} ({})".format(device, "mixed_float16" if mixed_precision else "float32")
+
+    cache_path = os.path.join(cache_dir, ".bs_cache")
+    cache = {}
+    if os.path.isfile(cache_path):
+      with open(cache_path, "r") as f:
+        cache = json.load(f)
+    if key in cache:
+      return cache[key]
+
+    best = candidates[0]
+    for batch_size in candidates:
+      model = self._create_model(mixed_precision)
+      model.compile(optimizer="adam", loss="binary_crossentropy")
+      idx = np.arange(min(batch_size, len(y)))
+      try:
+        for step in range(2):
+          model.train_on_batch(X[idx].astype("float32"), y[idx].astype("float32"))
+      except tf.errors.ResourceExhaustedError:
+        break
+      best = batch_size
+
+    cache[key] = best
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(cache_path, "w") as f:
+      json.dump(cache, f)
+
+    return best
+
+  # ============================================================================
+
+  def _materialize_dataset(self, dataset_path, cache_dir, chunk_size=2**20):
+    """Returns the features X and labels y of a ML dataset, memory-mapped from
+    a copy in cache_dir with contiguous float32 features and int8 labels; the
+    copy is made from the dataset if it doesn't exist or is older."""
+
+    name = os.path.splitext(os.path.basename(dataset_path))[0]
+    X_path = os.path.join(cache_dir, name + "_X.npy")
+    y_path = os.path.join(cache_dir, name + "_y.npy")
+
+    dataset_mtime = os.path.getmtime(dataset_path)
+    if not all(os.path.isfile(path) and os.path.getmtime(path) >= dataset_mtime for path in [X_path, y_path]):
+
+      print("Caching training set in {} ...".format(cache_dir))
+      os.makedirs(cache_dir, exist_ok=True)
+      names, X, y = self.load_ML_dataset(dataset_path)
+
+      # Copied a chunk at a time, so the dataset is never loaded in full; the
+      # files are written under temporary names until complete
+      X_cache = np.lib.format.open_memmap(X_path + ".tmp", mode="w+", dtype="float32", shape=X.shape)
+      for start in range(0, len(X), chunk_size):
+        X_cache[start:start+chunk_size] = X[start:start+chunk_size]
+      X_cache.flush()
+      del X_cache
+      os.replace(X_path + ".tmp", X_path)
+
+      np.save(y_path + ".tmp.npy", y.astype(np.int8))
+      os.replace(y_path + ".tmp.npy", y_path)
+
+    return np.load(X_path, mmap_mode="r"), np.load(y_path, mmap_mode="r")
+
+  # ============================================================================
+
+  def _build_dataset(self, X, y, indices, batch_size, shuffle=False, seed=None, device=None):
+    """Builds a tf.data pipeline that feeds the samples X[indices] and labels
+    y[indices] in batches, reshuffled every epoch if shuffle is True (with a
+    random generator seeded with seed, if given).
+
+    Only the (shuffled) batch indices are generated in Python; the samples of
+    each batch are gathered from X in parallel threads, and prefetched while
+    the model trains on the previous batches, so reading the (possibly
+    memory-mapped) dataset overlaps with training. If a device (e.g. "/gpu:0")
+    is given, the next batches are also copied to it in advance, so the
+    host-to-device transfers overlap with training too."""
+
+    NCH = X.shape[1]
+
+    # The same generator and index array are reused in every epoch, the
+    # indices being reshuffled in place
+    if shuffle:
+      rng = np.random.default_rng(seed)
+      order = np.array(indices)
+    else:
+      order = indices
+
+    def batch_indices():
+      if shuffle:
+        rng.shuffle(order)
+      for start in range(0, len(order), batch_size):
+        yield order[start:start+batch_size]
+
+    def gather(batch_idx):
+      # Sorted indices read the memory-mapped file in order
+      batch_idx = np.sort(batch_idx)
+      return X[batch_idx].astype("float32"), y[batch_idx].astype("float32")
+
+    def load_batch(batch_idx):
+      X_batch, y_batch = tf.numpy_function(gather, [batch_idx], [tf.float32, tf.float32])
+      X_batch.set_shape([None, NCH])
+      y_batch.set_shape([None])
+      return X_batch, y_batch
+
+    # The number of batches is declared, as keras can't infer it from a
+    # generator and needs it with steps_per_execution > 1
+    num_batches = (len(indices) + batch_size - 1) // batch_size
+    dataset = tf.data.Dataset.from_generator(batch_indices, output_signature=tf.TensorSpec(shape=[None], dtype=tf.int64))
+    dataset = dataset.apply(tf.data.experimental.assert_cardinality(num_batches))
+    dataset = dataset.map(load_batch, num_parallel_calls=tf.data.AUTOTUNE)
+    dataset = dataset.prefetch(tf.data.AUTOTUNE)
+
+    # Must be the last transformation of the pipeline
+    if device is not None:
+      dataset = dataset.apply(tf.data.experimental.prefetch_to_device(device, buffer_size=2))
+
+    return dataset
+
+  # ============================================================================
+
+  def test_model(self, test_set_path, model_path, remove_masked=True, predict_threshold=0.5, batch_size=2048, chunk_size=2**20):
     """Main routine to test a previously trained model using any ML training
     set previously created by generate_training_set().
 
@@ -303,6 +841,10 @@ class ASI_Index(Sargassum_Index):
       batch_size : integer (default: 2048)
         The batch size to use in training (passed to keras)
 
+      chunk_size : integer (default: 2**20)
+        The test set is read from disk and evaluated in chunks of this many
+        samples, so that it's never loaded in memory in full
+
     Returns:
 
       None; the results are printed to screen.
@@ -326,9 +868,7 @@ class ASI_Index(Sargassum_Index):
 
     names, XzTest, yzTest = self.load_ML_dataset(test_set_path)
 
-    num_non_sarg = np.count_nonzero(yzTest == 0)
-    num_sargassum = np.count_nonzero(yzTest == 1)
-    num_masked = np.count_nonzero(yzTest == 2)
+    num_non_sarg, num_sargassum, num_masked = np.bincount(yzTest, minlength=3)[:3]
 
     print()
     print(test_set_path)
@@ -336,8 +876,6 @@ class ASI_Index(Sargassum_Index):
     print("y shape: {}".format(" x ".join(str(x) for x in yzTest.shape)))
 
     if remove_masked:
-      XzTest = XzTest[yzTest != 2]
-      yzTest = yzTest[yzTest != 2]
       num_classes = 2
     else:
       yzTest[yzTest == 2] = 0
@@ -363,14 +901,26 @@ class ASI_Index(Sargassum_Index):
     # time_tested = time.time()
     # print("\nModel evaluation completed in {:.3f} s".format(time_tested - time_test_loaded))
 
-    Ypred = model.predict(XzTest, verbose=self.verbose, batch_size=batch_size)
+    # Confusion matrix, with labels as rows and predictions as columns; it's
+    # accumulated one chunk of the (memory-mapped) test set at a time, with
+    # masked samples removed from each chunk as it's read
+    cmatrix = np.zeros((num_classes, num_classes), dtype=np.int64)
+    for start in range(0, len(yzTest), chunk_size):
 
-    Ypred_cls = np.empty_like(Ypred, dtype=int)
-    Ypred_cls[Ypred >= predict_threshold] = 1
-    Ypred_cls[Ypred < predict_threshold] = 0
-    Ypred_cls = Ypred_cls.reshape((Ypred.shape[0],))
+      X_chunk = XzTest[start:start+chunk_size]
+      y_chunk = yzTest[start:start+chunk_size]
+      if remove_masked:
+        keep = (y_chunk != 2)
+        X_chunk = np.compress(keep, X_chunk, axis=0)
+        y_chunk = np.compress(keep, y_chunk, axis=0)
+      if len(y_chunk) == 0:
+        continue
 
-    cmatrix = tf.math.confusion_matrix(labels=yzTest, predictions=Ypred_cls, num_classes=num_classes).numpy()
+      Ypred = model.predict(X_chunk, verbose=self.verbose, batch_size=batch_size)
+      Ypred_cls = (Ypred >= predict_threshold).reshape((Ypred.shape[0],)).astype(np.int8)
+
+      idx = y_chunk.astype(np.int64) * num_classes + Ypred_cls
+      cmatrix += np.bincount(idx, minlength=num_classes**2).reshape((num_classes, num_classes))
 
     # Class 1 = sargassum is "positive" here
     TN = cmatrix[0, 0]
@@ -411,3 +961,84 @@ class ASI_Index(Sargassum_Index):
     print("\nCompleted evaluation in {:.3f} s".format(time_eval - time_loaded))
 
   # ============================================================================
+
+# ==============================================================================
+
+class _GradientAccumulation(keras.Model):
+  """Wraps a keras model to train it accumulating the gradients of several
+  batches before each weight update; used by ASI_Index.train_model()."""
+
+  def __init__(self, model, accum_steps):
+    super().__init__()
+    self.inner = model
+    self.accum_steps = accum_steps
+    self.accum_count = tf.Variable(0, dtype=tf.int64, trainable=False)
+    self.accum_grads = [tf.Variable(tf.zeros_like(v), trainable=False) for v in model.trainable_variables]
+
+  def call(self, inputs, training=False):
+    return self.inner(inputs, training=training)
+
+  def train_step(self, data):
+    x, y = data
+
+    # With mixed precision the loss is scaled, and the gradients unscaled
+    # before they're accumulated, so all batches use the same scale
+    loss_scaled = isinstance(self.optimizer, keras.mixed_precision.LossScaleOptimizer)
+
+    with tf.GradientTape() as tape:
+      y_pred = self(x, training=True)
+      loss = self.compiled_loss(y, y_pred, regularization_losses=self.losses)
+      if loss_scaled:
+        loss = self.optimizer.get_scaled_loss(loss)
+
+    grads = tape.gradient(loss, self.trainable_variables)
+    if loss_scaled:
+      grads = self.optimizer.get_unscaled_gradients(grads)
+
+    for accum_grad, grad in zip(self.accum_grads, grads):
+      accum_grad.assign_add(grad / self.accum_steps)
+    self.accum_count.assign_add(1)
+
+    # Update the weights every accum_steps batches
+    if self.accum_count % self.accum_steps == 0:
+      self.optimizer.apply_gradients(zip(self.accum_grads, self.trainable_variables))
+      for accum_grad in self.accum_grads:
+        accum_grad.assign(tf.zeros_like(accum_grad))
+
+    self.compiled_metrics.update_state(y, y_pred)
+    return {m.name: m.result() for m in self.metrics}
+
+# ==============================================================================
+
+class _BackgroundCheckpoint(keras.callbacks.Callback):
+  """Keras callback that saves a model every few epochs without stalling
+  training: the weights are copied into a clone of the model at the end of
+  the epoch, and the clone is written to disk in a background thread. Used
+  by ASI_Index.train_model()."""
+
+  def __init__(self, model, out_dir, every_epochs):
+    super().__init__()
+    self.target = model
+    self.out_dir = out_dir
+    self.every_epochs = every_epochs
+    self.executor = None
+    self.pending = []
+
+  def on_train_begin(self, logs=None):
+    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+  def on_epoch_end(self, epoch, logs=None):
+    if (epoch + 1) % self.every_epochs != 0:
+      return
+    snapshot = keras.models.clone_model(self.target)
+    snapshot.set_weights(self.target.get_weights())
+    out_path = os.path.join(self.out_dir, "checkpoint_epoch{}.h5".format(epoch + 1))
+    self.pending.append(self.executor.submit(snapshot.save, out_path))
+
+  def on_train_end(self, logs=None):
+    # Wait for the last checkpoints to be written (and report any error)
+    self.executor.shutdown(wait=True)
+    for future in self.pending:
+      future.result()
+
+# ==============================================================================
@@ -14,7 +14,10 @@ class Sargassum_Index:
 
   3) The 'compute()' method, which must receive at least the 'channels_data'
      parameter, a dict containing a parsed Sentinel-2 dataset as returned by
-     Sentinel2.load_channels(), and return a numpy array with the result."""
+     Sentinel2.load_channels(), and return a numpy array with the result.
+     When masking, detect_sargassum() passes only the unmasked pixels, as 1D
+     arrays, so compute() must work on channel arrays of any shape and
+     return a result of the same shape."""
 
   # Class variables -- to be overriden by derived clases
   name = None
@@ -25,9 +28,11 @@ class Sargassum_Index:
     """Derived classes must override this method.
 
     The single required parameter is channels_data, which must be a dict
-    with the structures specified by Sentinel2.load_channels().
+    with the structures specified by Sentinel2.load_channels(); the channel
+    arrays can have any shape (e.g. 1D when only unmasked pixels are passed).
 
-    Must return a numpy array with the result of the sargassum prediction."""
+    Must return a numpy array with the result of the sargassum prediction,
+    of the same shape as the channels."""
     raise NotImplementedError
 
 # ==============================================================================
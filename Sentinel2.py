@@ -2,14 +2,22 @@
 
 # ==============================================================================
 
+import concurrent.futures
+import contextlib
 import datetime
-import glob
+import hashlib
 import os
+import pickle
+import re
 import sys
+import threading
+import time
 import zipfile
 
-from sentinelsat import SentinelAPI
+import numpy as np
+from sentinelsat import SentinelAPI, InvalidChecksumError, LTAError, LTATriggered
 import rasterio
+import rasterio.windows
 
 # ==============================================================================
 
@@ -58,8 +66,14 @@ QUANT_VAL_ASI = float(2**16-1)    # Value required for older ASI models
 QUANT_VAL_S2 = 10000              # Value to use for AFAI or new ASI models
 
 # ==============================================================================
+# Names of Sentinel-2 L2A images, e.g. T16QEJ_20190706T160839_B02_20m.jp2; the
+# group is the image name (channel, SCL, etc.)
 
-def search_and_download_datasets(tiles, start_date, end_date, data_dir, username, password, unzip=False, max_retries=3, verbose=True, query_args=None):
+JP2_NAME_REGEX = re.compile(r"^.*_([A-Z0-9]+)_\d+m\.jp2$")
+
+# ==============================================================================
+
+def search_and_download_datasets(tiles, start_date, end_date, data_dir, username, password, unzip=False, max_retries=3, num_workers=4, verbose=True, query_args=None, search_cache_dir=None):
   """Search datasets (products) for the given list of tiles and the given date
   range, and download the found products (zip files) to data_dir, optionally
   unzipping them afer download.
@@ -99,6 +113,9 @@ def search_and_download_datasets(tiles, start_date, end_date, data_dir, username
     max_retries : integer (default: 3)
       The maximum number of retires
 
+    num_workers : integer (default: 4)
+      The number of products downloaded concurrently
+
     verbose : boolean (default: True)
       Whether to report progress to screen
 
@@ -106,6 +123,11 @@ def search_and_download_datasets(tiles, start_date, end_date, data_dir, username
       Additional query arguments to be passed directly to SentinelAPI.query()
       If None, orbitdirection will be set to 'Descending'
 
+    search_cache_dir : string (default: None)
+      If given, search results are cached in this directory, so re-running
+      the same download (e.g. to resume it) doesn't repeat the searches. See
+      search_products()
+
   Returns:
 
     None
@@ -117,7 +139,7 @@ def search_and_download_datasets(tiles, start_date, end_date, data_dir, username
 
   # Parse dates if strings
   if isinstance(start_date, str):
-    _start_date = datetime.datetime.strptime(start_date.replace("-", ""), "%Y%M%D")
+    _start_date = datetime.datetime.strptime(start_date.replace("-", ""), "%Y%m%d")
   else:
     _start_date = start_date
   if isinstance(end_date, str):
@@ -125,23 +147,29 @@ def search_and_download_datasets(tiles, start_date, end_date, data_dir, username
   else:
     _end_date = end_date
 
-  _date = _start_date
-  oneday = datetime.timedelta(days=1)
-  while _date <= _end_date:
-
-    if verbose:
-      print("\n>>", _date)
+  # A single search per tile covers the whole date range; both of its ends
+  # are inclusive, so it ends at the last instant of end_date, to include all
+  # of that day and none of the next. The searches for all tiles are done
+  # concurrently, since each search is mostly spent waiting for Copernicus;
+  # products are downloaded in tile order as the searches complete
+  if isinstance(_end_date, datetime.datetime):
+    _end_date = _end_date.date()
+  date_range = (_start_date, datetime.datetime.combine(_end_date, datetime.time.max))
+  tot_tiles = len(tiles)
+  with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(8, tot_tiles))) as executor:
+    searches = [executor.submit(search_products, tile=tile, date_range=date_range, query_args=query_args, username=username, password=password, cache_dir=search_cache_dir) for tile in tiles]
 
-    tot_tiles = len(tiles)
-    for count,tile in enumerate(tiles):
+    for count,(tile,search) in enumerate(zip(tiles, searches)):
 
-      # Search for products
-      products = search_products(tile=tile, date=_date.strftime("%Y%m%d"), query_args=query_args, username=username, password=password)
+      products = search.result()
 
       if verbose:
-        s = "\n{}, {} ({}/{}): ".format(_date.strftime("%Y-%m-%d"), tile, count+1, tot_tiles)
+        s = "\n{} ({}/{}): ".format(tile, count+1, tot_tiles)
         if len(products) > 0:
           s += "{} product{} found".format(len(products), "s" if len(products) > 1 else "")
+          # Sensing dates of the products found, from their names
+          dates = sorted(set(info["identifier"][11:19] for info in products.values()))
+          s += " on {}".format(", ".join("{}-{}-{}".format(d[0:4], d[4:6], d[6:8]) for d in dates))
         else:
           s += "no products found"
         print(s)
@@ -149,13 +177,11 @@ def search_and_download_datasets(tiles, start_date, end_date, data_dir, username
       if len(products) > 0:
 
         # Download products
-        download_products(products, data_dir, username, password, unzip=unzip, max_retries=max_retries, verbose=verbose)
-
-    _date += oneday
+        download_products(products, data_dir, username, password, unzip=unzip, max_retries=max_retries, num_workers=num_workers, verbose=verbose)
 
 # ==============================================================================
 
-def download_products(products, data_dir, username, password, unzip=False, max_retries=3, verbose=True):
+def download_products(products, data_dir, username, password, unzip=False, max_retries=3, num_workers=4, verbose=True):
   """Downloads a set of Sentinel-2 products.
 
   Parameters:
@@ -179,6 +205,11 @@ def download_products(products, data_dir, username, password, unzip=False, max_r
     max_retries : integer (default: 3)
       The maximum number of retires
 
+    num_workers : integer (default: 4)
+      The number of products downloaded concurrently; each download is
+      mostly spent waiting on the network, so overlapping them hides the
+      latency of each request
+
     verbose : boolean (default: True)
       Whether to report progress to screen
 
@@ -191,74 +222,226 @@ def download_products(products, data_dir, username, password, unzip=False, max_r
     print("Error: you must provide your Copernicus credentials; you can set them in download_datasets.py")
     sys.exit()
 
-  # Login to Copernicus
-  api = SentinelAPI(username, password)
+  if len(products) == 0:
+    return
+
+  # Products are unzipped in their own thread as their downloads complete,
+  # so that unzipping (CPU and disk bound) overlaps with the downloads still
+  # in progress (network bound) instead of holding up a download slot
+  num_workers = max(1, min(num_workers, len(products)))
+  with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as downloader, concurrent.futures.ThreadPoolExecutor(max_workers=1) as unzipper:
+    downloads = [downloader.submit(_download_product, product_id, product_info, data_dir, username, password, max_retries, verbose) for product_id, product_info in products.items()]
+    unzips = []
+    for download in concurrent.futures.as_completed(downloads):
+      zip_fpath = download.result()
+      if unzip and zip_fpath is not None:
+        unzips.append(unzipper.submit(_unzip_product, zip_fpath, verbose))
+    for future in unzips:
+      future.result()
 
-  for product_id, product_info in products.items():
+# ==============================================================================
 
-    tile = product_info["identifier"].split("_")[5][1:]
-    tile_dir_path = os.path.join(data_dir, "T{}".format(tile))
-    zip_fname = product_info["identifier"] + ".zip"
-    zip_fpath = os.path.join(tile_dir_path, zip_fname)
+def _download_product(product_id, product_info, data_dir, username, password, max_retries, verbose):
+  """Downloads a single product, unless already downloaded; used by
+  download_products() in its worker threads. Returns the path of the zip
+  file, or None if the download failed."""
 
-    if os.path.isfile(zip_fpath):
+  tile = product_info["identifier"].split("_")[5][1:]
+  tile_dir_path = os.path.join(data_dir, "T{}".format(tile))
+  zip_fname = product_info["identifier"] + ".zip"
+  zip_fpath = os.path.join(tile_dir_path, zip_fname)
 
-      # Skip download if the zip already exists
-      if verbose:
-        print("Already downloaded: {}".format(product_info["identifier"]))
+  if os.path.isfile(zip_fpath):
 
-    else:
-
-      # Create tile subdir if not found
-      if not os.path.exists(tile_dir_path):
-        os.makedirs(tile_dir_path)
+    # Skip download if the zip already exists
+    if verbose:
+      print("Already downloaded: {}".format(product_info["identifier"]))
 
-      # Download (and check with MD5) product
-      if verbose:
-        print(product_info["identifier"])
-
-      tries_left = max_retries
-      while tries_left > 0:
-        try:
-          result = api.download(product_id, tile_dir_path)
-          break
-        except SentinelAPI.InvalidChecksumError:
-          tries_left -= 1
-          if verbose:
-            if tries_left > 0:
-              print("Bad MD5 checksum! Retrying.")
-            else:
-              print("Bad MD5 checksum! Max retries reached; skipping.")
-          os.remove(zip_fpath)
-        except:
-          tries_left -= 1
-          if verbose:
-            if tries_left > 0:
-              print("Unknown error! Retrying.")
-            else:
-              print("Unknown error! Skipping.")
+  else:
 
-      if verbose:
-        print("Downloaded {}".format(zip_fname))
+    # Create tile subdir if not found
+    os.makedirs(tile_dir_path, exist_ok=True)
 
-    # Unzip if asked
-    if unzip:
-      unzipped_fname = product_info["identifier"] + ".SAFE"
-      unzipped_path = os.path.join(tile_dir_path, unzipped_fname)
-      if os.path.exists(unzipped_path):
+    # Download (and check with MD5) product
+    if verbose:
+      print("Downloading {}".format(product_info["identifier"]))
+
+    tries_left = max_retries
+    while tries_left > 0:
+      try:
+        # Login to Copernicus
+        with _get_api(username, password) as api:
+          _stream_download(api, product_id, zip_fpath)
+        break
+      except LTATriggered:
+        # Retrying now is pointless: the product takes hours to be restored
         if verbose:
-          print("Dataset already unzipped")
-      else:
+          print("{} is offline; its retrieval from the Long Term Archive was requested, try again later. Skipping.".format(zip_fname))
+        return None
+      except LTAError as e:
         if verbose:
-          print("Unzipping dataset ...")
-        with zipfile.ZipFile(zip_fpath, "r") as zip:
-          zip.extractall(tile_dir_path)
+          print("{} is offline and its retrieval couldn't be requested: {}! Skipping.".format(zip_fname, e))
+        return None
+      except InvalidChecksumError:
+        tries_left -= 1
         if verbose:
-          print("Unzipped {}".format(unzipped_fname))
+          if tries_left > 0:
+            print("Bad MD5 checksum for {}! Retrying.".format(zip_fname))
+          else:
+            print("Bad MD5 checksum for {}! Max retries reached; skipping.".format(zip_fname))
+        if os.path.isfile(zip_fpath):
+          os.remove(zip_fpath)
+      except Exception as e:
+        tries_left -= 1
+        if verbose:
+          if tries_left > 0:
+            print("Error downloading {}: {}! Retrying.".format(zip_fname, e))
+          else:
+            print("Error downloading {}: {}! Skipping.".format(zip_fname, e))
+
+    if tries_left == 0:
+      return None
+
+    if verbose:
+      print("Downloaded {}".format(zip_fname))
+
+  return zip_fpath
+
+# ==============================================================================
+
+def _unzip_product(zip_fpath, verbose):
+  """Unzips a downloaded product next to its zip file, unless already
+  unzipped."""
+
+  tile_dir_path, zip_fname = os.path.split(zip_fpath)
+  unzipped_fname = os.path.splitext(zip_fname)[0] + ".SAFE"
+  unzipped_path = os.path.join(tile_dir_path, unzipped_fname)
+
+  if os.path.exists(unzipped_path):
+    if verbose:
+      print("Dataset already unzipped: {}".format(unzipped_fname))
+  else:
+    if verbose:
+      print("Unzipping {} ...".format(zip_fname))
+    _unzip(zip_fpath, tile_dir_path)
+    if verbose:
+      print("Unzipped {}".format(unzipped_fname))
+
+# ==============================================================================
+
+# Idle SentinelAPI clients for each (username, password), used by _get_api()
+_idle_apis = {}
+_idle_apis_lock = threading.Lock()
+
+@contextlib.contextmanager
+def _get_api(username, password):
+  """Context manager that lends a SentinelAPI client for the given
+  credentials, returned to a module-level pool on exit. Clients (and their
+  HTTP sessions and open connections) are thus reused by later searches and
+  downloads, in this or later calls, instead of starting a new one every
+  time; but each is used by a single thread at a time, as requests.Session
+  isn't thread-safe. A new client is only created when all are in use."""
+
+  key = (username, password)
+  with _idle_apis_lock:
+    idle = _idle_apis.setdefault(key, [])
+    api = idle.pop() if len(idle) > 0 else None
+  if api is None:
+    api = SentinelAPI(username, password)
+
+  try:
+    yield api
+  finally:
+    with _idle_apis_lock:
+      _idle_apis[key].append(api)
 
 # ==============================================================================
 
-def search_products(tile=None, date=None, search_string=None, product_type="L2A", username=None, password=None, satellite=None, query_args=None):
+def _stream_download(api, product_id, zip_fpath, chunk_size=2**20):
+  """Downloads a product to zip_fpath, computing its MD5 checksum from the
+  chunks as they're written, instead of reading the whole file back from
+  disk after the download as SentinelAPI.download() does; raises
+  InvalidChecksumError if it doesn't match the one published.
+
+  Products that are offline (moved to the Long Term Archive) can't be
+  downloaded right away; as SentinelAPI.download() does, their retrieval is
+  requested and LTATriggered is raised."""
+
+  odata = api.get_product_odata(product_id)
+
+  if not odata["Online"]:
+    api.trigger_offline_retrieval(product_id)
+    raise LTATriggered(product_id)
+
+  # Download to a temporary name, so that an interrupted download isn't
+  # taken as complete
+  tmp_fpath = zip_fpath + ".incomplete"
+  md5 = hashlib.md5()
+  # The client's timeout is kept in its session (in sentinelsat 1.x)
+  timeout = getattr(api.session, "timeout", None)
+  with api.session.get(odata["url"], stream=True, timeout=timeout) as response:
+    response.raise_for_status()
+    with open(tmp_fpath, "wb") as f:
+      for chunk in response.iter_content(chunk_size=chunk_size):
+        f.write(chunk)
+        md5.update(chunk)
+
+  if md5.hexdigest().lower() != odata["md5"].lower():
+    os.remove(tmp_fpath)
+    raise InvalidChecksumError("MD5 checksum mismatch for {}".format(os.path.basename(zip_fpath)))
+
+  os.replace(tmp_fpath, zip_fpath)
+
+# ==============================================================================
+
+def _unzip(zip_fpath, dest_dir, num_threads=None):
+  """Extracts a zip file to dest_dir using several threads, each with its own
+  handle on the zip; zlib releases the GIL while inflating, so the JP2 images
+  in a product are decompressed and written in parallel instead of one after
+  another as in ZipFile.extractall()."""
+
+  with zipfile.ZipFile(zip_fpath, "r") as zip:
+    members = zip.infolist()
+
+  # Create the directory tree beforehand: ZipFile.extract() creates missing
+  # directories without exist_ok, so threads extracting into the same one
+  # could fail with FileExistsError. Member names are sanitized as extract()
+  # does, dropping drive letters and empty, "." and ".." components, so that
+  # no directory is created outside dest_dir
+  for member in members:
+    name = os.path.splitdrive(member.filename.replace("/", os.path.sep))[1]
+    parts = [part for part in name.split(os.path.sep) if part not in ["", os.path.curdir, os.path.pardir]]
+    if not member.is_dir():
+      parts = parts[:-1]
+    if len(parts) > 0:
+      os.makedirs(os.path.join(dest_dir, *parts), exist_ok=True)
+  members = [member for member in members if not member.is_dir()]
+  if len(members) == 0:
+    return
+
+  if num_threads is None:
+    num_threads = os.cpu_count()
+  num_threads = max(1, min(num_threads, len(members)))
+
+  # Deal the members, largest first, to the thread with the least data so far
+  groups = [[] for i in range(num_threads)]
+  sizes = [0] * num_threads
+  for member in sorted(members, key=lambda m: m.file_size, reverse=True):
+    i = sizes.index(min(sizes))
+    groups[i].append(member)
+    sizes[i] += member.file_size
+
+  def extract(group):
+    with zipfile.ZipFile(zip_fpath, "r") as zip:
+      for member in group:
+        zip.extract(member, dest_dir)
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+    list(executor.map(extract, groups))
+
+# ==============================================================================
+
+def search_products(tile=None, date=None, date_range=None, search_string=None, product_type="L2A", username=None, password=None, satellite=None, query_args=None, cache_dir=None, cache_ttl=86400):
   """Searches Copernicus SciHub for Sentinel-2 datasets (products) for a given
   tile and date. Alternatively, if search_string is given pass that directly
   to the Copernicus API (ignoring all other arguments).
@@ -274,6 +457,11 @@ def search_products(tile=None, date=None, search_string=None, product_type="L2A"
       The date for which to the tile. Can be a string in "YYYY-MM-DD" or
       "YYYYMMDD" format, or a Python date or datetime object
 
+    date_range : tuple (default: None)
+      Alternatively to date, a (start, end) tuple with the range of sensing
+      dates to search in a single query, passed directly to SentinelAPI.query()
+      as its date argument (both ends are inclusive)
+
     -- OR --
 
     search_string : string
@@ -296,6 +484,13 @@ def search_products(tile=None, date=None, search_string=None, product_type="L2A"
       Additional query arguments to be passed directly to SentinelAPI.query().
       If None, orbitdirection will be set to 'Descending'
 
+    cache_dir : string (default: None)
+      If given, search results are cached in this directory, so that repeating
+      a search (e.g. when resuming downloads) doesn't query Copernicus again
+
+    cache_ttl : numeric (default: 86400)
+      The time in seconds a cached search result is considered valid
+
   Returns:
 
     A dictionary with the found products, with UUIDs as keys
@@ -308,9 +503,8 @@ def search_products(tile=None, date=None, search_string=None, product_type="L2A"
   # Parse dates if strings
   if date is not None and isinstance(date, str):
     _date = datetime.datetime.strptime(date.replace("-", ""), "%Y%m%d")
-
-  # Login to Copernicus
-  api = SentinelAPI(username, password)
+  else:
+    _date = date
 
   # Generate product search string if not giben
   if search_string is None:
@@ -320,29 +514,51 @@ def search_products(tile=None, date=None, search_string=None, product_type="L2A"
     else:
       search_string += "S2*"
     search_string += "_MSI{}".format(product_type)
-    search_string += "_{}*".format(_date.strftime("%Y%m%d"))
+    if _date is not None:
+      search_string += "_{}*".format(_date.strftime("%Y%m%d"))
+    else:
+      search_string += "_*"
     search_string += "_N*_R*"
     search_string += "_T{}".format(tile)
     search_string += "_*"
 
-  if query_args is not None:
-    if "orbitdirection" not in query_args:
-      query_args["orbitdirection"] = "Descending"
-
-  # Search Copernicus for products
   if query_args is None:
-    products = api.query(filename=search_string)
-  else:
-    products = api.query(filename=search_string, *query_args)
+    query_args = {}
+  query_args = dict(query_args)
+  if "orbitdirection" not in query_args:
+    query_args["orbitdirection"] = "Descending"
+  if date_range is not None:
+    query_args["date"] = tuple(date_range)
+
+  # Return the cached result of the same search, if there's a recent one
+  if cache_dir is not None:
+    key = repr((search_string, sorted(query_args.items())))
+    cache_path = os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest() + ".pickle")
+    if os.path.isfile(cache_path) and time.time() - os.path.getmtime(cache_path) < cache_ttl:
+      with open(cache_path, "rb") as f:
+        return pickle.load(f)
+
+  # Login to Copernicus and search for products
+  with _get_api(username, password) as api:
+    products = api.query(filename=search_string, **query_args)
 
   if len(products) > 0:
-    return products
+    products = dict(products)
   else:
-    return {}
+    products = {}
+
+  if cache_dir is not None:
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+      pickle.dump(products, f)
+    os.replace(tmp_path, cache_path)
+
+  return products
 
 # ==============================================================================
 
-def load_channels(dataset_path, channels, resolution, img_data_path=None, s2_quant=QUANT_VAL_ASI, verbose=False):
+def load_channels(dataset_path, channels, resolution, img_data_path=None, s2_quant=QUANT_VAL_ASI, dtype="float32", num_threads=None, window=None, verbose=False):
   """ Load bottom-of-atmosphere reflectivity channels from a Sentinel-2 dataset
 
   Parameters:
@@ -358,11 +574,29 @@ def load_channels(dataset_path, channels, resolution, img_data_path=None, s2_qua
 
   Options:
 
+    img_data_path : string (default: None)
+      The image data directory of the dataset at the given resolution, as
+      returned by locate_data_path(); located if not given
+
     s2_quant : numeric value (default: QUANT_VAL_ASI)
       Sentinel-2 QUANTIFICATION_VALUE to convert from digital levels to
       reflectance; defaults to the value used by the older ASI models, but
       QUANT_VAL_S2 should be used for AFAI or new ASI models
 
+    dtype : string or numpy dtype (default: "float32")
+      The floating-point type of the returned reflectance arrays; "float16"
+      halves the memory used by the loaded channels
+
+    num_threads : integer (default: None)
+      The number of threads used to decode the channel images in parallel;
+      defaults to one per channel, up to the number of CPUs
+
+    window : rasterio.windows.Window (default: None)
+      If given, only read this window of the images (e.g. an area of
+      interest), which avoids decoding the rest of each image; the returned
+      metadata describes the window. All channels must have the same
+      resolution, so the window applies equally to all of them
+
     verbose : boolean (default: True)
       Whether to report progress to screen
 
@@ -381,15 +615,17 @@ def load_channels(dataset_path, channels, resolution, img_data_path=None, s2_qua
   """
   # ----------------------------------------------------------------------------
 
-  img_data_path = locate_data_path(dataset_path, resolution)
   if img_data_path is None:
-    return None
+    img_data_path = locate_data_path(dataset_path, resolution)
+    if img_data_path is None:
+      return None
 
-  dataset = {"meta": None, "channels": {}}
+  # Locate the images of all channels first
+  jp2_index = _index_jp2(img_data_path)
+  img_paths = []
   for ch_name in channels:
 
-    pattern = os.path.join(img_data_path, "*_{}_*.jp2".format(ch_name))
-    paths = glob.glob(pattern)
+    paths = jp2_index.get(ch_name, [])
 
     if len(paths) == 0:
       print("Couldn't find image for channel {}".format(ch_name))
@@ -398,13 +634,16 @@ def load_channels(dataset_path, channels, resolution, img_data_path=None, s2_qua
     if len(paths) > 1:
       print("Warning: multiple channel {} images found; using first".format(ch_name))
 
-    img_path = paths[0]
+    img_paths.append(paths[0])
 
-    # Stored Sentinel-2 L2A data is stored as uint16, we convert it to float32
-    # to have 15 bits of precision in calculations
-    dtype = "float32"
-    img = rasterio.open(img_path, driver='JP2OpenJPEG')
-    data = img.read(1).astype(dtype)
+  # Decode the channels in parallel; rasterio releases the GIL while decoding
+  if num_threads is None:
+    num_threads = min(len(channels), os.cpu_count())
+  with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+    loaded = list(executor.map(lambda path: _load_channel(path, s2_quant, dtype, window), img_paths))
+
+  dataset = {"meta": None, "channels": {}}
+  for ch_name, img_path, (data, meta) in zip(channels, img_paths, loaded):
 
     if verbose:
       NX, NY = data.shape
@@ -413,14 +652,11 @@ def load_channels(dataset_path, channels, resolution, img_data_path=None, s2_qua
     if dataset["meta"] is None:
       dataset["meta"] = {}
       dataset["meta"]["dtype"] = dtype
-      dataset["meta"]["nodata"] = img.meta["nodata"]
-      dataset["meta"]["width"] = img.meta["width"]
-      dataset["meta"]["height"] = img.meta["height"]
-      dataset["meta"]["crs"] = img.meta["crs"]
-      dataset["meta"]['transform'] = img.meta["transform"]
-
-    # Convert the Sentinel-2 stored data to reflectivity values
-    data /= float(s2_quant)
+      dataset["meta"]["nodata"] = meta["nodata"]
+      dataset["meta"]["width"] = meta["width"]
+      dataset["meta"]["height"] = meta["height"]
+      dataset["meta"]["crs"] = meta["crs"]
+      dataset["meta"]['transform'] = meta["transform"]
 
     dataset["channels"][ch_name] = data
 
@@ -428,7 +664,144 @@ def load_channels(dataset_path, channels, resolution, img_data_path=None, s2_qua
 
 # ==============================================================================
 
-def load_SCL(dataset_path, resolution, return_path=False):
+def load_channels_cached(dataset_path, channels, resolution, cache_dir, s2_quant=QUANT_VAL_ASI, dtype="float32", window=None, verbose=False):
+  """ Like load_channels(), but keeps the decoded channels in a cache directory
+  so that repeated runs over the same dataset (e.g. computing several indices,
+  or sweeping thresholds) don't have to decode the JP2 images again
+
+  The first time a channel is requested the whole image is decoded and saved
+  as a .npy file in cache_dir; afterwards it's memory-mapped, so only the
+  parts actually used (e.g. a window) are read from disk. The cache key
+  includes the dataset name, channel, resolution, quantification value and
+  dtype. The returned arrays are read-only.
+
+  Parameters:
+
+    dataset_path, channels, resolution : as in load_channels()
+
+    cache_dir : string
+      The directory where the decoded channels are stored; created if it
+      doesn't exist
+
+  Options:
+
+    s2_quant, dtype, window, verbose : as in load_channels()
+
+  Returns:
+
+    A dictionary with the same structure as load_channels()
+
+  """
+  # ----------------------------------------------------------------------------
+
+  img_data_path = locate_data_path(dataset_path, resolution)
+  if img_data_path is None:
+    return None
+
+  os.makedirs(cache_dir, exist_ok=True)
+
+  # Cache file names start with the tile and sensing time for readability,
+  # followed by a hash of everything that determines the stored values
+  basename = os.path.basename(os.path.normpath(dataset_path)).replace(".SAFE", "")
+  cache_paths = {}
+  for ch_name in channels:
+    key = "{}|{}|{}|{}|{}".format(basename, ch_name, resolution, s2_quant, np.dtype(dtype).name)
+    digest = hashlib.sha1(key.encode()).hexdigest()[:12]
+    fname = "{}_{}_{}_{}m_{}.npy".format(basename[39:44], basename[11:26], ch_name, resolution, digest)
+    cache_paths[ch_name] = os.path.join(cache_dir, fname)
+
+  # Decode and store the missing channels
+  missing = [ch_name for ch_name in channels if not os.path.exists(cache_paths[ch_name])]
+  if len(missing) > 0:
+    decoded = load_channels(dataset_path, missing, resolution, img_data_path=img_data_path, s2_quant=s2_quant, dtype=dtype, verbose=verbose)
+    if decoded is None:
+      return None
+    for ch_name in missing:
+      # Write to a temporary name first so an interrupted run doesn't leave a
+      # truncated file behind that would be taken as valid
+      tmp_path = cache_paths[ch_name] + ".tmp.npy"
+      np.save(tmp_path, decoded["channels"][ch_name])
+      os.replace(tmp_path, cache_paths[ch_name])
+      if verbose:
+        print("Cached {} in {}".format(ch_name, cache_paths[ch_name]))
+    del decoded
+
+  # The metadata only needs the image header, not its data
+  ch_path = _index_jp2(img_data_path)[channels[0]][0]
+  with rasterio.open(ch_path, driver='JP2OpenJPEG') as img:
+    if window is None:
+      window = rasterio.windows.Window(0, 0, img.width, img.height)
+    dataset = {"meta": {}, "channels": {}}
+    dataset["meta"]["dtype"] = dtype
+    dataset["meta"]["nodata"] = img.nodata
+    dataset["meta"]["width"] = int(window.width)
+    dataset["meta"]["height"] = int(window.height)
+    dataset["meta"]["crs"] = img.crs
+    dataset["meta"]['transform'] = img.window_transform(window)
+
+  rows, cols = window.toslices()
+  for ch_name in channels:
+    dataset["channels"][ch_name] = np.load(cache_paths[ch_name], mmap_mode="r")[rows, cols]
+    if verbose:
+      NX, NY = dataset["channels"][ch_name].shape
+      print("Loaded {} from cache, {} x {}".format(ch_name, NX, NY))
+
+  return dataset
+
+# ==============================================================================
+
+def _load_channel(img_path, s2_quant, dtype, window=None):
+  """Reads a single channel image (or a window of it) and converts it to
+  reflectance; returns the tuple (data, meta) with the data array and the
+  rasterio metadata of the area read.
+
+  The image is decoded one JP2 tile (block) at a time, into a single raw
+  buffer reused for all blocks, and each is converted to reflectance while
+  still in cache, writing into the preallocated output, instead of decoding
+  the whole image at once and converting it afterwards."""
+
+  # Blocks are read once each, so GDAL's block cache only needs to hold the
+  # ones being decoded; the dataset is closed (releasing its cache and
+  # decoder) as soon as the channel is read
+  with rasterio.Env(GDAL_CACHEMAX=64, GDAL_NUM_THREADS="ALL_CPUS"):
+
+    with rasterio.open(img_path, driver='JP2OpenJPEG', USE_TILE_AS_BLOCK="YES") as img:
+
+      if window is None:
+        window = rasterio.windows.Window(0, 0, img.width, img.height)
+      row_off, col_off = int(window.row_off), int(window.col_off)
+      height, width = int(window.height), int(window.width)
+
+      data = np.empty((height, width), dtype=dtype)
+      inv_quant = np.float32(1.0/s2_quant)
+      block_rows, block_cols = img.block_shapes[0]
+      scratch = np.empty(block_rows*block_cols, dtype="uint16")
+
+      for _, block in img.block_windows(1):
+
+        # The part of the block inside the window, if any
+        r0, r1 = max(block.row_off, row_off), min(block.row_off + block.height, row_off + height)
+        c0, c1 = max(block.col_off, col_off), min(block.col_off + block.width, col_off + width)
+        if r0 >= r1 or c0 >= c1:
+          continue
+
+        # Stored Sentinel-2 L2A data is stored as uint16; it's read as such and
+        # converted to reflectance in a single pass straight into the output.
+        # The product is computed in float32 (raw values can overflow float16)
+        # and only then cast to the requested dtype
+        buf = scratch[:(r1 - r0)*(c1 - c0)].reshape((r1 - r0, c1 - c0))
+        img.read(1, window=rasterio.windows.Window(c0, r0, c1 - c0, r1 - r0), out=buf)
+        np.multiply(buf, inv_quant, out=data[r0-row_off:r1-row_off, c0-col_off:c1-col_off], dtype="float32", casting="unsafe")
+
+      meta = img.meta.copy()
+      meta["height"], meta["width"] = data.shape
+      meta["transform"] = img.window_transform(window)
+
+  return data, meta
+
+# ==============================================================================
+
+def load_SCL(dataset_path, resolution, return_path=False, window=None):
   """ Load Scene Classification Layer at given resolution from a Sentinel-2
   dataset
 
@@ -445,6 +818,9 @@ def load_SCL(dataset_path, resolution, return_path=False):
     return_path : boolean (default: False)
       Whether to return the path to the found SCL instead of the data
 
+    window : rasterio.windows.Window (default: None)
+      If given, only read this window of the SCL
+
   Returns:
 
     A numpy array with the SCL, or the file path if return_path is true
@@ -456,24 +832,42 @@ def load_SCL(dataset_path, resolution, return_path=False):
   if img_data_path is None:
     return None
 
-  pattern = os.path.join(img_data_path, "*_SCL_*.jp2")
-  paths = glob.glob(pattern)
+  paths = _index_jp2(img_data_path).get("SCL", [])
 
   if len(paths) == 0:
-    print("Couldn't find SCL image in {}!".format(pattern))
+    print("Couldn't find SCL image in {}!".format(img_data_path))
     return None
 
   if len(paths) > 1:
     print("Warning: multiple SCL masks found")
   SCL_path = paths[0]
 
-  SCL_im = rasterio.open(SCL_path, driver='JP2OpenJPEG')
-  SCL = SCL_im.read(1)
-
   if return_path:
     return SCL_path
-  else:
-    return SCL
+
+  with rasterio.open(SCL_path, driver='JP2OpenJPEG') as SCL_im:
+    SCL = SCL_im.read(1, window=window)
+
+  return SCL
+
+# ==============================================================================
+
+def _index_jp2(img_data_path):
+  """Lists the JP2 images in an image data directory in a single pass.
+
+  Returns a dict with the image names (e.g. "B02", "SCL") as keys and sorted
+  lists of the paths of matching images as values."""
+
+  index = {}
+  for entry in os.scandir(img_data_path):
+    match = JP2_NAME_REGEX.match(entry.name)
+    if match is not None:
+      index.setdefault(match.group(1), []).append(entry.path)
+
+  for paths in index.values():
+    paths.sort()
+
+  return index
 
 # ==============================================================================
 
@@ -496,11 +890,20 @@ def locate_data_path(dataset_path, resolution):
   """
   # ----------------------------------------------------------------------------
 
-  pattern = os.path.join(dataset_path, "GRANULE/L2A*/IMG_DATA/R{}m".format(int(resolution)))
-  paths = glob.glob(pattern)
+  # The image data is in GRANULE/L2A*/IMG_DATA/R<resolution>m; list the
+  # granules directly instead of globbing
+  granule_path = os.path.join(dataset_path, "GRANULE")
+  res_dir = "R{}m".format(int(resolution))
+  paths = []
+  if os.path.isdir(granule_path):
+    for entry in os.scandir(granule_path):
+      path = os.path.join(entry.path, "IMG_DATA", res_dir)
+      if entry.name.startswith("L2A") and os.path.isdir(path):
+        paths.append(path)
+  paths.sort()
 
   if len(paths) == 0:
-    print("Couldn't find IMG_DATA directory at {}m resolution in {}".format(resolution, pattern))
+    print("Couldn't find IMG_DATA directory at {}m resolution in {}".format(resolution, os.path.join(granule_path, "L2A*", "IMG_DATA", res_dir)))
     return None
 
   if len(paths) > 1:
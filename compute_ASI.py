@@ -17,6 +17,17 @@ dataset_path = "./T16QEJ/S2B_MSIL2A_20190706T160839_N0212_R140_T16QEJ_20190706T2
 # Path to the ASI model to use
 model_path = "ASImodelColabv2.h5"
 
+# Batch size for the ASI predictions -- this can be large!
+batch_size = 2048
+
+# How to evaluate the model: "keras" (TensorFlow, can use a GPU) or "numpy"
+# (plain matrix products on the CPU, fastest for the small ASI networks)
+backend = "numpy"
+
+# Convert the model once to the SavedModel format, which loads faster in later
+# runs? (only for .h5 models)
+cache_savedmodel = False
+
 # Output directory
 out_dir = "./"
 
@@ -46,7 +57,7 @@ verbose = True
 # ==============================================================================
 
 # Initialize ASI index, loading the specified model
-index = ASI_Index(model_path=model_path, verbose=verbose)
+index = ASI_Index(model_path=model_path, batch_size=batch_size, backend=backend, cache_savedmodel=cache_savedmodel, verbose=verbose)
 
 # Compute index on image
 result = detect_sargassum(dataset_path, index, out_dir=out_dir, apply_mask=apply_mask, mask_keep_categs=mask_keep_categs, threshold=threshold, save_npy=save_npy, save_geotiff=save_geotiff, save_jp2=save_jp2, verbose=verbose)
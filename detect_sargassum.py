@@ -2,6 +2,8 @@
 
 # =====================================================
 
+import concurrent.futures
+import contextlib
 import datetime
 import glob
 import os
@@ -9,6 +11,7 @@ import sys
 
 import numpy as np
 import rasterio
+import rasterio.windows
 
 import Sentinel2
 from AFAI import AFAI_Index
@@ -16,7 +19,14 @@ from ASI import ASI_Index
 
 # ==============================================================================
 
-def detect_sargassum(dataset_path, sarg_index, compute_kwargs={}, apply_mask=True, mask_keep_categs=[6], masked_value=np.nan, threshold=None, resolution="20", save_npy=False, save_geotiff=False, save_jp2=False, out_dir=None, verbose=True):
+# Largest quantized value, and value used for masked pixels, when saving
+# results as uint16
+QUANT_MAX = 65534
+QUANT_NODATA = 65535
+
+# ==============================================================================
+
+def detect_sargassum(dataset_path, sarg_index, compute_kwargs={}, apply_mask=True, mask_keep_categs=[6], masked_value=np.nan, threshold=None, resolution="20", channels_dtype="float32", window=None, strip_rows=None, cache_dir=None, quantize_range=None, save_npy=False, save_geotiff=False, save_jp2=False, out_dir=None, verbose=True):
   """Computes a sargassum index from a Sentinel-2 dataset.
 
   Parameters:
@@ -52,6 +62,35 @@ def detect_sargassum(dataset_path, sarg_index, compute_kwargs={}, apply_mask=Tru
       The Sentinel-2 spatial resolution to use. All channels required by the
       Sargassum_Index must be available at this resolution. Defaults to 20 m.
 
+    channels_dtype : string or numpy dtype (default: "float32")
+      The floating-point type in which the Sentinel-2 channels are loaded;
+      "float16" halves the memory they use. See Sentinel2.load_channels().
+
+    window : rasterio.windows.Window (default: None)
+      If given, the detection is only done in this window of the image (e.g.
+      an area of interest), and only this part of the images is decoded. The
+      output images are georeferenced to the window.
+
+    strip_rows : integer (default: None)
+      If given, the channels are loaded and the index computed in strips of
+      this many rows, so that only one strip of the channels is in memory at
+      a time; the output image is still computed in full. If None, the whole
+      image is processed at once.
+
+    cache_dir : string (default: None)
+      If given, the decoded channels are cached in this directory, so that
+      later runs on the same dataset (e.g. with another index or threshold)
+      read them from the cache instead of decoding the images again. See
+      Sentinel2.load_channels_cached().
+
+    quantize_range : tuple (default: None)
+      If given as (min, max), an unthresholded result is saved to GeoTIFF and
+      JPEG2000 as uint16 values scaled linearly to this range, instead of as
+      floats; this halves the output size and allows JPEG2000 output. The
+      scale and offset are stored in the image metadata, and masked pixels
+      are stored as the nodata value 65535. ASI values are in [0, 1]. The
+      result returned and saved as numpy array is not affected.
+
     save_npy : boolean (default: False)
       Whether to save the data in the output image as a numpy array.
 
@@ -74,7 +113,8 @@ def detect_sargassum(dataset_path, sarg_index, compute_kwargs={}, apply_mask=Tru
 
     result : numpy array
       A numpy array of same shape as the channels with the result of the
-      sargassum detection
+      sargassum detection; if save_npy is True, this is a numpy memmap of the
+      saved .npy file
   """
   # ----------------------------------------------------------------------------
 
@@ -83,7 +123,9 @@ def detect_sargassum(dataset_path, sarg_index, compute_kwargs={}, apply_mask=Tru
   basename = os.path.basename(os.path.normpath(dataset_path))
   if verbose:
     print("\nComputing sargassum index {} for Sentinel-2 dataset:\n{}".format(sarg_index.name, dataset_path))
-  date = datetime.datetime.strptime(basename[11:26], "%Y%m%dT%H%M%S")
+  # The sensing time has the fixed format YYYYMMDDTHHMMSS
+  t = basename[11:26]
+  date = datetime.datetime(int(t[0:4]), int(t[4:6]), int(t[6:8]), int(t[9:11]), int(t[11:13]), int(t[13:15]))
   tile = basename[39:44]
   satellite = basename[1:3]
   if verbose:
@@ -92,139 +134,307 @@ def detect_sargassum(dataset_path, sarg_index, compute_kwargs={}, apply_mask=Tru
     print("Satellite: Sentinel-{}".format(satellite))
 
   # --------------------------------------------------
-  # Load required channels at requested resolution
-
-  img_data_path = Sentinel2.locate_data_path(dataset_path, resolution)
+  # Load SCL (if using mask)
 
   if verbose:
-    print("\nLoading channels {} ...".format(sarg_index.required_channels))
+    print("\nLoading SCL mask ...")
 
-  dataset = Sentinel2.load_channels(dataset_path, sarg_index.required_channels, resolution, verbose=verbose)
+  # SCL values are uint8 categories, so the mask is a lookup in a table that
+  # marks the categories to mask out (i.e. all but those to keep); it's True
+  # for the pixels to mask
+  masked_lut = np.ones(256, dtype=bool)
+  masked_lut[list(mask_keep_categs)] = False
 
-  ch0 = dataset["channels"][sarg_index.required_channels[0]]
-  NX, NY = ch0.shape
-  NTOT = NX * NY
-  img_meta = dataset["meta"]
-  NCH = len(dataset)
+  # The SCL is decoded in the background, overlapping with the decoding of
+  # the channels, and only waited for when the mask is first needed
+  SCL_loader = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+  SCL_future = SCL_loader.submit(_load_SCL_mask, dataset_path, resolution, window, masked_lut, verbose)
+  SCL_loader.shutdown(wait=False)
+  SCL_masked = None
 
   # --------------------------------------------------
-  # Load SCL (if using mask)
+  # Load required channels at requested resolution and compute index, one
+  # strip of rows at a time; the threshold and mask are applied and the
+  # GeoTIFF written as each strip is done
+
+  # The image directory is located once, rather than on every strip
+  img_data_path = Sentinel2.locate_data_path(dataset_path, resolution)
+  if img_data_path is None:
+    return None
+
+  # The output has the size of the window, or of the images (read from the
+  # SCL header, since the SCL itself may not be loaded yet)
+  if window is not None:
+    NX, NY = int(window.height), int(window.width)
+    row_off, col_off = int(window.row_off), int(window.col_off)
+  else:
+    with rasterio.open(Sentinel2.load_SCL(dataset_path, resolution, return_path=True)) as SCL_im:
+      NX, NY = SCL_im.shape
+    row_off, col_off = 0, 0
+  if strip_rows is None:
+    strip_rows = NX
+
+  index_name = sarg_index.name.replace(" ", "_")
+  out_basename = "{}_{}_{}".format(tile, date.strftime("%Y%m%d"), index_name)
+  if out_dir is None:
+    out_dir = dataset_path
 
   if verbose:
-    print("\nLoading SCL mask ...")
+    print("\nLoading channels {} and computing {} ...".format(sarg_index.required_channels, sarg_index.name))
+    if threshold is not None:
+      print("Applying threshold of {}".format(threshold))
+    if apply_mask:
+      print("Applying mask")
+
+  def load_strip(r0):
+    """Loads the channels in the strip of rows starting at r0"""
+    rows = min(strip_rows, NX - r0)
+    if window is None and rows == NX:
+      strip_window = None
+    else:
+      strip_window = rasterio.windows.Window(col_off, row_off + r0, NY, rows)
+    if cache_dir is not None:
+      return Sentinel2.load_channels_cached(dataset_path, sarg_index.required_channels, resolution, cache_dir, dtype=channels_dtype, window=strip_window, verbose=verbose)
+    else:
+      return Sentinel2.load_channels(dataset_path, sarg_index.required_channels, resolution, img_data_path=img_data_path, dtype=channels_dtype, window=strip_window, verbose=verbose)
+
+  def write_strip(r0, strip_result):
+    """Copies a computed strip into the result and writes it to the GeoTIFF"""
+    rows = strip_result.shape[0]
+    if result is not strip_result:
+      result[r0:r0+rows] = strip_result
+    if save_geotiff:
+      out_strip = quantize_uint16(strip_result, q_offset, q_scale) if quantize else strip_result
+      geotiff.write(out_strip, 1, window=rasterio.windows.Window(0, r0, NY, rows))
+
+  # The strips go through a pipeline: the next strip is decoded and the
+  # previous one written while the current one is computed, each stage in its
+  # own thread (decoding, numpy/TensorFlow and GDAL writes all release the
+  # GIL). At most one strip waits in each stage, bounding memory use
+  result = None
+  strip_starts = list(range(0, NX, strip_rows))
+  with contextlib.ExitStack() as outputs:
+
+    # The stage threads are shut down before the outputs are closed
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as loader, concurrent.futures.ThreadPoolExecutor(max_workers=1) as writer:
+
+      next_load = loader.submit(load_strip, strip_starts[0])
+      last_write = None
+
+      for i, r0 in enumerate(strip_starts):
+
+        rows = min(strip_rows, NX - r0)
+        if verbose and rows < NX:
+          print("\nRows {}-{} of {}".format(r0, r0 + rows - 1, NX))
+
+        dataset = next_load.result()
+        if i + 1 < len(strip_starts):
+          next_load = loader.submit(load_strip, strip_starts[i+1])
+
+        if SCL_masked is None:
+          SCL_masked = SCL_future.result()
+
+        # When masking, the index is only computed on the unmasked pixels,
+        # gathered into 1D arrays, and the results scattered back afterwards
+        if apply_mask:
+          strip_valid = ~SCL_masked[r0:r0+rows]
+          channels = {ch: data[strip_valid] for ch, data in dataset["channels"].items()}
+        else:
+          channels = dataset["channels"]
+
+        strip_result = sarg_index.compute(channels, **compute_kwargs)
+
+        # Apply threshold and mask, if requested. When both are, the comparison
+        # is scattered straight into the uint8 output prefilled with the masked
+        # class 2, instead of thresholding into an intermediate array first
+        if apply_mask:
+          valid_result = strip_result
+          if threshold is not None:
+            strip_result = np.full((rows, NY), 2, dtype="uint8")
+            strip_result[strip_valid] = np.greater_equal(valid_result, threshold)
+          else:
+            strip_result = np.full((rows, NY), masked_value, dtype=valid_result.dtype)
+            strip_result[strip_valid] = valid_result
+          del valid_result
+
+        # Otherwise the comparison is written straight into the uint8 output
+        # (viewed as bool, which has the same layout), without temporaries
+        elif threshold is not None:
+          thresholded = np.empty(strip_result.shape, dtype="uint8")
+          np.greater_equal(strip_result, threshold, out=thresholded.view(bool))
+          strip_result = thresholded
+
+        # The output is allocated when its dtype is known (unless there's a
+        # single strip), and is georeferenced as the first strip, but with the
+        # full number of rows
+        if result is None:
+
+          img_meta = dataset["meta"]
+          img_meta["height"] = NX
+
+          # If saving as a numpy array, the output is a memory-mapped .npy
+          # file, so strips are written to disk by the OS as they're computed
+          if save_npy:
+            npy_path = os.path.join(out_dir, out_basename + ".npy")
+            result = np.lib.format.open_memmap(npy_path, mode="w+", dtype=strip_result.dtype, shape=(NX, NY))
+          elif rows == NX:
+            result = strip_result
+          else:
+            result = np.empty((NX, NY), dtype=strip_result.dtype)
+
+          # Float results are saved quantized to uint16, if requested
+          quantize = quantize_range is not None and np.issubdtype(result.dtype, np.floating)
+          if quantize:
+            q_offset = quantize_range[0]
+            q_scale = (quantize_range[1] - quantize_range[0]) / QUANT_MAX
+            out_dtype = "uint16"
+          else:
+            out_dtype = result.dtype
+
+          # Open the GeoTIFF, if requested: tiled and compressed, with the
+          # predictor suited to the data type
+          if save_geotiff:
+            tif_meta = dict(img_meta, driver="GTiff", dtype=out_dtype, count=1)
+            tif_meta.update(tiled=True, blockxsize=512, blockysize=512, compress="deflate", predictor=3 if np.issubdtype(out_dtype, np.floating) else 2, num_threads="all_cpus", bigtiff="if_safer")
+            if quantize:
+              tif_meta["nodata"] = QUANT_NODATA
+            tif_path = os.path.join(out_dir, out_basename + ".tif")
+            geotiff = outputs.enter_context(rasterio.open(tif_path, "w", **tif_meta))
+            if quantize:
+              geotiff.scales = (q_scale,)
+              geotiff.offsets = (q_offset,)
+
+        # Hand the strip over to be saved, once the previous one is
+        if last_write is not None:
+          last_write.result()
+        last_write = writer.submit(write_strip, r0, strip_result)
+
+      last_write.result()
+
+  if save_geotiff and verbose:
+    print("\nWrote {}".format(tif_path))
 
-  SCL = Sentinel2.load_SCL(dataset_path, resolution)
-  SCL_mask = np.isin(SCL, mask_keep_categs)
+  # --------------------------------------------------
+  # Finish saving result to disk as a numpy array, if requested
 
-  if verbose:
+  if save_npy:
 
-    mask_categs, counts = np.unique(SCL, return_counts=True)
-    mask_counts = dict(zip(mask_categs, counts))
-    print("Mask counts:", mask_counts)
+    result.flush()
 
-    mask_keep_count = np.count_nonzero(SCL_mask)
-    print("{:,} ({:.1f}%) pixels are unmasked".format(mask_keep_count, 100*mask_keep_count/SCL.size))
+    if verbose:
+      print("\nWrote {}".format(npy_path))
 
   # --------------------------------------------------
-  # Compute index
+  # Save result to disk as JPEG2000, if requested
 
-  if verbose:
-    print("\nComputing {} ...".format(sarg_index.name))
+  if save_jp2 and result.dtype not in ["uint8"] and not quantize:
+    print("\nWarning: can't save float image as JPEG2000 unless quantized; skipping")
+    save_jp2 = False
 
-  result = sarg_index.compute(dataset["channels"], **compute_kwargs)
+  if save_jp2:
 
-  # --------------------------------------------------
-  # Apply threshold, if requested
+    # Copy image metadata from the channels; the image is compressed
+    # losslessly, so that classes and quantized values are preserved
+    img_meta['driver'] = "JP2OpenJPEG"
+    img_meta['dtype'] = out_dtype
+    img_meta['count'] = 1
+    img_meta.update(quality=100, reversible="YES")
+    if quantize:
+      img_meta['nodata'] = QUANT_NODATA
 
-  if threshold is not None:
+    out_path = os.path.join(out_dir, out_basename + ".jp2")
 
-    if verbose:
-      print("\nApplying threshold of {} ...".format(threshold))
+    with rasterio.open(out_path, "w", **img_meta) as fout:
+      if quantize:
+        fout.write(quantize_uint16(result, q_offset, q_scale), 1)
+        fout.scales = (q_scale,)
+        fout.offsets = (q_offset,)
+      else:
+        fout.write(result, 1)
 
-    result = np.where(result >= threshold, 1, 0).astype("uint8")
+    if verbose:
+      print("\nWrote {}".format(out_path))
 
   # --------------------------------------------------
-  # Apply mask, if requested
 
-  if apply_mask:
-
-    if verbose:
-      print("\nApplying mask ...")
+  return result
 
-    if threshold is not None:
-      result[~SCL_mask] = 2
-    else:
-      result[~SCL_mask] = masked_value
+# =====================================================
 
-  # --------------------------------------------------
-  # Save result to disk as a numpy array, if requested
+def _load_SCL_mask(dataset_path, resolution, window, masked_lut, verbose):
+  """Loads the SCL of a dataset and returns the mask of the pixels to mask
+  out, marked as True in masked_lut; when verbose, the SCL statistics are
+  printed."""
 
-  if save_npy:
+  SCL = Sentinel2.load_SCL(dataset_path, resolution, window=window)
+  SCL_masked = masked_lut[SCL]
 
-    index_name = sarg_index.name.replace(" ", "_")
-    fname = "{}_{}_{}.npy".format(tile, date.strftime("%Y%m%d"), index_name)
+  if verbose:
 
-    if out_dir is None:
-      out_dir = dataset_path
-    out_path = os.path.join(out_dir, fname)
+    # A single histogram pass gives both the category counts and the number
+    # of unmasked pixels
+    SCL_hist = np.bincount(SCL.ravel(), minlength=256)
+    mask_counts = {c: SCL_hist[c] for c in np.flatnonzero(SCL_hist)}
+    mask_keep_count = SCL_hist[~masked_lut].sum()
+    print("\nMask counts: {}\n{:,} ({:.1f}%) pixels are unmasked".format(mask_counts, mask_keep_count, 100*mask_keep_count/SCL.size))
 
-    np.save(out_path, result)
+  return SCL_masked
 
-    if verbose:
-      print("\nWrote {}".format(out_path))
+# =====================================================
 
-  # --------------------------------------------------
-  # Save result to disk as GeoTIFF, if requested
+def quantize_uint16(data, offset, scale):
+  """Quantizes a float array to uint16 as round((data - offset) / scale),
+  clipped to [0, QUANT_MAX]; NaN values are set to QUANT_NODATA. The original
+  values are recovered (to within scale/2) as offset + scale * quantized."""
 
-  if save_geotiff :
+  nan = np.isnan(data)
 
-    # Copy image metadata from SCL mask
-    img_meta['driver'] = "GTiff"
-    img_meta['dtype'] = result.dtype
-    img_meta['count'] = 1
+  scaled = np.subtract(data, offset, dtype="float32")
+  scaled *= 1.0/scale
+  np.clip(scaled, 0, QUANT_MAX, out=scaled)
+  scaled += 0.5
+  np.putmask(scaled, nan, 0)
 
-    index_name = sarg_index.name.replace(" ", "_")
-    fname = "{}_{}_{}.tif".format(tile, date.strftime("%Y%m%d"), index_name)
+  quantized = np.empty(data.shape, dtype="uint16")
+  np.copyto(quantized, scaled, casting="unsafe")
+  np.putmask(quantized, nan, QUANT_NODATA)
 
-    if out_dir is None:
-      out_dir = dataset_path
-    out_path = os.path.join(out_dir, fname)
+  return quantized
 
-    with rasterio.open(out_path, "w", **img_meta) as fout:
-      fout.write(result, 1)
+# =====================================================
 
-    if verbose:
-      print("\nWrote {}".format(out_path))
+def detect_sargassum_batch(dataset_paths, sarg_index, num_workers=2, **kwargs):
+  """Computes a sargassum index for several Sentinel-2 datasets, processing
+  num_workers datasets concurrently so that decoding the images of one
+  overlaps with computing the index of another.
 
-  # --------------------------------------------------
-  # Save result to disk as JPEG2000, if requested
+  Parameters:
 
-  if save_jp2 and result.dtype not in ["uint8"]:
-    print("\nWarning: can't save float image as JPEG2000; skipping")
-    save_jp2 = False
+    dataset_paths : list of strings
+      The paths to the .SAFE directories of the datasets
 
-  if save_jp2:
+    sarg_index : an instance of a class derived from Sargassum_Index
+      The sargassum index to use for the detection; a single instance (and
+      model) is shared by all workers
 
-    # Copy image metadata from SCL mask
-    img_meta['driver'] = "JP2OpenJPEG"
-    img_meta['dtype'] = result.dtype
+  Options:
 
-    index_name = sarg_index.name.replace(" ", "_")
-    fname = "{}_{}_{}.jp2".format(tile, date.strftime("%Y%m%d"), index_name)
+    num_workers : integer (default: 2)
+      The number of datasets to process at the same time
 
-    if out_dir is None:
-      out_dir = dataset_path
-    out_path = os.path.join(out_dir, fname)
+    Any other keyword argument is passed on to detect_sargassum().
 
-    with rasterio.open(out_path, "w", **img_meta) as fout:
-      fout.write(result, 1)
+  Returns:
 
-    if verbose:
-      print("\nWrote {}".format(out_path))
+    A dict with the dataset paths as keys and the results returned by
+    detect_sargassum() as values
+  """
 
-  # --------------------------------------------------
+  with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+    futures = {path: executor.submit(detect_sargassum, path, sarg_index, **kwargs) for path in dataset_paths}
+    results = {path: future.result() for path, future in futures.items()}
 
-  return result
+  return results
 
 # =====================================================
 
@@ -4,7 +4,6 @@
 
 import glob
 import os
-import random
 import sys
 
 import numpy as np
@@ -15,7 +14,7 @@ import Sentinel2
 
 # ==============================================================================
 
-def generate_training_set(dataset_path, out_dir="./", full_array=True, AFAI_threshold=0.005, mask_keep_categs=[6], verbose=True):
+def generate_training_set(dataset_path, out_dir="./", full_array=True, AFAI_threshold=0.005, mask_keep_categs=[6], compress=False, verbose=True):
   """Create an ASI training set from a Sentinel-2 dataset using AFAI
 
   This is done by computing the AFAI and applying a user-specified threshold
@@ -52,6 +51,12 @@ def generate_training_set(dataset_path, out_dir="./", full_array=True, AFAI_thre
 
   With this option no masked pixels are saved.
 
+  If compress is True, the training set is instead saved as a compressed .npz
+  file with three arrays: "X" with the 9 bands as float16 (reflectance values,
+  no rescaling needed), "y" with the class as int8 and, for the small training
+  set, "coords" with the i,j coordinates as uint16. This is about a quarter of
+  the size of the .npy file.
+
   Parameters:
 
     dataset_path : string
@@ -74,6 +79,10 @@ def generate_training_set(dataset_path, out_dir="./", full_array=True, AFAI_thre
       The classes of the SCL mask where the sargassum classification is done.
       6 is water.
 
+    compress : boolean (default: False)
+      Save the training set as a compressed .npz file with float16 features
+      instead of a float32 .npy file. See details above.
+
   Returns:
 
     None; the result is saved to disk
@@ -85,7 +94,6 @@ def generate_training_set(dataset_path, out_dir="./", full_array=True, AFAI_thre
   ASI_features = ["B02", "B03", "B04", "B05", "B06", "B07", "B8A", "B11", "B12"]
 
   basename = os.path.basename(os.path.normpath(dataset_path))
-  out_fname = "{}_{}_train.npy".format(basename[39:44], basename[11:26])
 
   # Initialize AFAI
   AFAI_index = AFAI_Index(verbose=verbose)
@@ -93,9 +101,8 @@ def generate_training_set(dataset_path, out_dir="./", full_array=True, AFAI_thre
   # Create classification mask from AFAI
   AFAI_mask = detect_sargassum(dataset_path, AFAI_index, apply_mask=True, mask_keep_categs=mask_keep_categs, masked_value=2, threshold=AFAI_threshold, resolution="20", save_npy=False, save_geotiff=False, save_jp2=False, verbose=verbose)
 
-  num_sarg = np.count_nonzero(AFAI_mask == 1)
-  num_not_sarg = np.count_nonzero(AFAI_mask == 0)
-  num_masked = np.count_nonzero(AFAI_mask == 2)
+  # Count all classes in a single pass over the mask
+  num_not_sarg, num_sarg, num_masked = np.bincount(AFAI_mask.ravel(), minlength=3)[:3]
   NX, NY = AFAI_mask.shape
   NTOT = AFAI_mask.size
   NFEAT = len(ASI_features)
@@ -113,53 +120,76 @@ def generate_training_set(dataset_path, out_dir="./", full_array=True, AFAI_thre
 
   if full_array:
 
-    # Just stack and reshape
-    train_set = np.stack([ASI_dataset["channels"][ch] for ch in ASI_features] + [AFAI_mask.astype("float32")])
-    train_set = np.transpose(train_set, axes=(1,2,0))
+    # Fill the output directly in its (NX, NY, NFEAT+1) layout, one column at
+    # a time, instead of stacking the channels and transposing the stack,
+    # which needed an extra copy of the whole set
+    train_set = np.empty((NX, NY, NFEAT+1), dtype="float32")
+    for l, ch in enumerate(ASI_features):
+      train_set[:, :, l] = ASI_dataset["channels"][ch]
+      del ASI_dataset["channels"][ch]
+    train_set[:, :, NFEAT] = AFAI_mask
 
   else:
 
     if verbose:
       print("\nBuilding minimal training set ...")
 
-    # Extract coordinates
+    # Extract the flat indices of the pixels of each class; these take half
+    # the memory of their (i, j) coordinates
     if verbose:
       print("Extracting coordinates ...")
-    sargassum_coords = np.argwhere(AFAI_mask == 1)
-    not_sargassum_coords = np.argwhere(AFAI_mask == 0)
+    AFAI_flat = AFAI_mask.reshape(-1)
+    sargassum_idx = np.flatnonzero(AFAI_flat == 1)
+    not_sargassum_idx = np.flatnonzero(AFAI_flat == 0)
 
-    num_sarg = len(sargassum_coords)
+    num_sarg = len(sargassum_idx)
     num_tot = 2*num_sarg
     ncols = 2 + NFEAT + 1
 
-    # Randomly choose equal number of non-sargassum coords
+    # Randomly choose equal number of non-sargassum pixels
     if verbose:
       print("Randomly selecting non-sargassum pixels ...")
-    nonsarg_coords = random.sample(list(not_sargassum_coords), num_sarg)
+    rng = np.random.default_rng()
+    nonsarg_idx = rng.choice(not_sargassum_idx, num_sarg, replace=False)
+    del not_sargassum_idx
+    flat_idx = np.concatenate([sargassum_idx, nonsarg_idx])
 
-    # Pack data
+    # Pack data, gathering each column for all selected pixels at once with a
+    # 1D np.take by flat index, instead of a 2D fancy-indexing gather
     if verbose:
       print("Packing data ...")
+    coords = np.unravel_index(flat_idx, AFAI_mask.shape)
     train_set = np.empty((num_tot, ncols), dtype="float32")
-    for k in range(num_tot):
-      if k <= num_sarg-1:
-        i, j = sargassum_coords[k]
-      else:
-        i, j = not_sargassum_coords[k]
-      train_set[k, 0] = i
-      train_set[k, 1] = j
-      for l in range(NFEAT):
-        train_set[k, 2+l] = ASI_dataset["channels"][ASI_features[l]][i,j]
-      train_set[k, ncols-1] = AFAI_mask[i,j]
+    train_set[:, 0] = coords[0]
+    train_set[:, 1] = coords[1]
+    for l, ch in enumerate(ASI_features):
+      train_set[:, 2+l] = np.take(ASI_dataset["channels"][ch].reshape(-1), flat_idx)
+    train_set[:, ncols-1] = np.take(AFAI_flat, flat_idx)
 
   # Write training set to disk
-  out_fname = "T{}_{}_ML_{}.npy".format(basename[39:44], basename[11:26], "full" if full_array else "small")
-  out_path = os.path.join(out_dir, out_fname)
+  out_fname = "T{}_{}_ML_{}".format(basename[39:44], basename[11:26], "full" if full_array else "small")
   if verbose:
     print("\nWriting training set to disk ...")
-  np.save(out_path, train_set)
-  if verbose:
-    print("Saved {}, {}, {:.1f} MB".format(out_path, " x ".join(str(x) for x in train_set.shape), train_set.nbytes/1024**2))
+
+  if compress:
+
+    # Bands as float16 and classes as int8, in separate arrays
+    out_path = os.path.join(out_dir, out_fname + ".npz")
+    arrays = {}
+    arrays["X"] = train_set[..., -NFEAT-1:-1].astype("float16")
+    arrays["y"] = train_set[..., -1].astype("int8")
+    if not full_array:
+      arrays["coords"] = train_set[:, 0:2].astype("uint16")
+    np.savez_compressed(out_path, **arrays)
+    if verbose:
+      print("Saved {}, {}, {:.1f} MB".format(out_path, " x ".join(str(x) for x in arrays["X"].shape), os.path.getsize(out_path)/1024**2))
+
+  else:
+
+    out_path = os.path.join(out_dir, out_fname + ".npy")
+    np.save(out_path, train_set)
+    if verbose:
+      print("Saved {}, {}, {:.1f} MB".format(out_path, " x ".join(str(x) for x in train_set.shape), train_set.nbytes/1024**2))
 
 # ==============================================================================
 
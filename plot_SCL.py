@@ -17,6 +17,39 @@ import Sentinel2
 
 # ==============================================================================
 
+# The SCL classes
+# https://earth.esa.int/web/sentinel/technical-guides/sentinel-2-msi/level-2a/algorithm
+SCL_classes = {
+  0: {"name": "NO_DATA", "color": "#000000"},
+  1: {"name": "SATURATED_OR_DEFECTIVE", "color": "#fb0c00"},
+  2: {"name": "DARK_AREA_PIXELS", "color": "#3e3e3e"},
+  3: {"name": "CLOUD_SHADOWS", "color": "#843900"},
+  4: {"name": "VEGETATION", "color": "#29ff00"},
+  5: {"name": "NOT_VEGETATED", "color": "#feff00"},
+  6: {"name": "WATER", "color": "#1500cd"},
+  7: {"name": "UNCLASSIFIED", "color": "#767271"},
+  8: {"name": "CLOUD_MEDIUM_PROBABILITY", "color": "#afacab"},
+  9: {"name": "CLOUD_HIGH_PROBABILITY", "color": "#d1cfcf"},
+  10: {"name": "THIN_CIRRUS", "color": "#2ccdff"},
+  11: {"name": "SNOW", "color": "#fd66ff"}
+}
+
+# Convert hex value to RGB tuple
+def hex_to_rgb(hx):
+  hx = hx.lstrip("#")
+  return tuple(int(hx[i:i+2], 16) for i in (0, 2, 4))
+
+for c in SCL_classes.keys():
+  SCL_classes[c]["rgb_color"] = hex_to_rgb(SCL_classes[c]["color"])
+
+# RGB colors indexed by SCL value, built once; values outside the SCL classes
+# are black
+SCL_palette = np.zeros((256, 3), dtype=np.uint8)
+for c in SCL_classes.keys():
+  SCL_palette[c] = SCL_classes[c]["rgb_color"]
+
+# ==============================================================================
+
 def plot_SCL(dataset_path, resolution, show_image=True, save_png=False, save_geotiff=False, out_dir="./"):
   """ Plots the SCL layer from a Sentinel-2 dataset
 
@@ -50,33 +83,8 @@ def plot_SCL(dataset_path, resolution, show_image=True, save_png=False, save_geo
   """
   # ----------------------------------------------------------------------------
 
-  # The SCL classes
-  # https://earth.esa.int/web/sentinel/technical-guides/sentinel-2-msi/level-2a/algorithm
-  SCL_classes = {
-    0: {"name": "NO_DATA", "color": "#000000"},
-    1: {"name": "SATURATED_OR_DEFECTIVE", "color": "#fb0c00"},
-    2: {"name": "DARK_AREA_PIXELS", "color": "#3e3e3e"},
-    3: {"name": "CLOUD_SHADOWS", "color": "#843900"},
-    4: {"name": "VEGETATION", "color": "#29ff00"},
-    5: {"name": "NOT_VEGETATED", "color": "#feff00"},
-    6: {"name": "WATER", "color": "#1500cd"},
-    7: {"name": "UNCLASSIFIED", "color": "#767271"},
-    8: {"name": "CLOUD_MEDIUM_PROBABILITY", "color": "#afacab"},
-    9: {"name": "CLOUD_HIGH_PROBABILITY", "color": "#d1cfcf"},
-    10: {"name": "THIN_CIRRUS", "color": "#2ccdff"},
-    11: {"name": "SNOW", "color": "#fd66ff"}
-  }
-
-  # Convert hex value to RGB tuple
-  def hex_to_rgb(hx):
-    hx = hx.lstrip("#")
-    return tuple(int(hx[i:i+2], 16) for i in (0, 2, 4))
-
   # ----------------------------------------------------------------------------
 
-  for c in SCL_classes.keys():
-    SCL_classes[c]["rgb_color"] = hex_to_rgb(SCL_classes[c]["color"])
-
   # Load mask
   SCL_path = Sentinel2.load_SCL(dataset_path, resolution, return_path=True)
   SCL_im = rasterio.open(SCL_path, driver='JP2OpenJPEG')
@@ -96,9 +104,9 @@ def plot_SCL(dataset_path, resolution, show_image=True, save_png=False, save_geo
   if save_png or show_image:
 
     print("Creating image ...")
-    img_data = np.zeros((ny, nx, 3), dtype=np.uint8)
-    for c in SCL_classes.keys():
-      img_data[SCL == c] = SCL_classes[c]["rgb_color"]
+    # Colors are looked up in the palette indexed by the SCL value, in a
+    # single pass over the image instead of one per class
+    img_data = SCL_palette[SCL]
     img = Image.fromarray(img_data, 'RGB')
 
     out_fname = base_name + ".png"
@@ -17,14 +17,7 @@ def plot_npy(file_path, out_dir="./", cmap="viridis", save_image=False, show_ima
   NX, NY = data.shape
   print("Loaded {}, {} x {}, {:.1f} MB".format(file_path, NX, NY, data.nbytes/1024**2))
 
-  if not show_image:
-    mpl.use("Agg")
-
-  import matplotlib.pyplot as plt
   import matplotlib.colors as mcolors
-  from mpl_toolkits.axes_grid1 import make_axes_locatable
-
-  fig = plt.figure()
 
   # if isinstance(cmap, str):
   #   cmap = mpl.cm.get_cmap(cmap)
@@ -33,6 +26,25 @@ def plot_npy(file_path, out_dir="./", cmap="viridis", save_image=False, show_ima
 
   cmap.set_bad("0.05")
 
+  out_basename = os.path.splitext(os.path.basename(file_path))[0]
+  out_path = os.path.join(out_dir, out_basename + ".png")
+
+  # Without a colorbar or display, the image is just the colormapped data, so
+  # it's written directly with PIL instead of being rendered by matplotlib
+  if save_image and not show_image and not show_colorbar:
+    print("Writing image ...")
+    _save_png(data, cmap, out_path)
+    print("Saved {}".format(out_path))
+    return
+
+  if not show_image:
+    mpl.use("Agg")
+
+  import matplotlib.pyplot as plt
+  from mpl_toolkits.axes_grid1 import make_axes_locatable
+
+  fig = plt.figure()
+
   im = plt.imshow(data, cmap=cmap)
 
   plt.gca().get_xaxis().set_visible(False)
@@ -53,9 +65,6 @@ def plot_npy(file_path, out_dir="./", cmap="viridis", save_image=False, show_ima
 
   if save_image:
     print("Writing image ...")
-    out_basename = os.path.splitext(os.path.basename(file_path))[0]
-    fname = out_basename + ".png"
-    out_path = os.path.join(out_dir, fname)
     plt.savefig(out_path, bbox_inches=0)
     print("Saved {}".format(out_path))
 
@@ -63,6 +72,34 @@ def plot_npy(file_path, out_dir="./", cmap="viridis", save_image=False, show_ima
     print("Plotting image ...")
     plt.show()
 
+# ==============================================================================
+
+def _save_png(data, cmap, out_path):
+  """Saves data as a PNG image colored with cmap, scaled to its range like
+  imshow() does, with NaN pixels in the colormap's "bad" color; one pixel per
+  array element. Requires Pillow."""
+
+  from PIL import Image
+
+  # The colormap as a lookup table of 256 colors, plus the "bad" color
+  N = 256
+  lut = np.empty((N+1, 3), dtype=np.uint8)
+  lut[:N] = np.round(cmap(np.arange(N))[:, :3] * 255)
+  lut[N] = np.round(np.array(cmap(np.nan)[:3]) * 255)
+
+  # Color levels, as matplotlib computes them from the normalized values
+  vmin, vmax = np.nanmin(data), np.nanmax(data)
+  scale = N / (vmax - vmin) if vmax > vmin else 0
+  levels = np.subtract(data, vmin, dtype="float32")
+  levels *= scale
+  bad = np.isnan(levels)
+  levels[bad] = 0
+  np.clip(levels, 0, N-1, out=levels)
+  levels = levels.astype(np.uint16)
+  levels[bad] = N
+
+  Image.fromarray(lut[levels], "RGB").save(out_path)
+
 
 # ==============================================================================
 
@@ -4,14 +4,44 @@ Created on Thu Dec  5 12:47:06 2019
 @author: urielm
 """
 
-import pandas as pd
 import geopandas as gpd
-from osgeo import gdal
+import fiona
+from fiona.transform import transform_geom
+from osgeo import gdal, ogr, osr
 
 from glob import glob
 from datetime import datetime
+from multiprocessing import Pool
 import os
 
+def polygonizeGeotiff(file, path_shp):
+	"""Funcion que poligoniza un GeoTIFF en un Shapefile con el campo DN, igual que
+	gdal_polygonize.py pero dentro del mismo proceso
+
+	Ejemplo:
+	file = './data_GeoTIFF/T16QEJ_20190706T160839_AFAI.tif'
+	path_shp = './data_Shapefile/T16QEJ_20190706T160839_out.shp'
+	"""
+	src = gdal.Open(file)
+	band = src.GetRasterBand(1)
+
+	drv = ogr.GetDriverByName('ESRI Shapefile')
+	if os.path.exists(path_shp):
+		drv.DeleteDataSource(path_shp)
+	dst = drv.CreateDataSource(path_shp)
+
+	srs = osr.SpatialReference(wkt=src.GetProjection())
+	layer = dst.CreateLayer('out', srs=srs)
+	layer.CreateField(ogr.FieldDefn('DN', ogr.OFTInteger))
+
+	gdal.Polygonize(band, band.GetMaskBand(), layer, 0, [], callback=None)
+
+	# Cerrar los archivos para que se escriban a disco
+	dst = None
+	src = None
+
+	return path_shp
+
 def geotiffTogeojson(path_GeoTIFF, path_Geojson, path_Shapefile):
 	"""Funcion que convierte el GeoTIFF binario de 0 y 1, en un formato vectorial GeoJson, con atributos de
 	id, tiempo, area, fecha y tile
@@ -24,9 +54,19 @@ def geotiffTogeojson(path_GeoTIFF, path_Geojson, path_Shapefile):
 	files = glob(path_GeoTIFF+'*.tif')
 	files.sort()
 
+	# Poligonizar todos los archivos en paralelo, un proceso por archivo
+	shapefiles = []
+	for file in files:
+		tile = file.split('/')[-1].split('_')[0]
+		timeS = file.split('/')[-1].split('_')[1]
+		shapefiles.append(path_Shapefile+tile+'_'+timeS+'_out.shp')
+
+	with Pool(os.cpu_count()) as pool:
+		pool.starmap(polygonizeGeotiff, zip(files, shapefiles))
+
 	index = 0
 
-	for file in files:
+	for file, shapefile in zip(files, shapefiles):
 
 		tile = file.split('/')[-1].split('_')[0]
 		timeS = file.split('/')[-1].split('_')[1]
@@ -36,9 +76,7 @@ def geotiffTogeojson(path_GeoTIFF, path_Geojson, path_Shapefile):
 		print(tile)
 		print(dateT.strftime('%Y-%m-%dT%H:%M:%SZ'))
 
-		os.system('gdal_polygonize.py '+file+' '+path_Shapefile+tile+'_'+timeS+'_out.shp')
-
-		df = gpd.read_file(path_Shapefile+tile+'_'+timeS+'_out.shp')
+		df = gpd.read_file(shapefile)
 
 		df = df[df.DN == 1]
 
@@ -72,21 +110,19 @@ def multiGeojson(path_Geojson,multi_Geojson):
 	files_json = glob(path_Geojson+'*.json')
 	files_json.sort()
 
-	gdf_b = gpd.read_file(files_json[0])
-	gdf_b = gdf_b.to_crs({'init': 'epsg:4326'})
-
 	print ('Creando multijson ...')
-	for json in files_json[1:]:
-
-		gdf_i = gpd.read_file(json)
-
-		gdf_i = gdf_i.to_crs({'init': 'epsg:4326'})
 
-		gdf_b = pd.concat([gdf_b,gdf_i])
+	# Escribir los poligonos de cada archivo al multijson conforme se leen,
+	# reproyectados a EPSG:4326, sin tener todos en memoria a la vez
+	with fiona.open(files_json[0]) as src0:
+		schema = src0.schema
 
-	#gdf_b = gdf_b.to_crs({'init': 'epsg:4326'})
-
-	gdf_b.to_file(multi_Geojson, driver="GeoJSON")
+	with fiona.open(multi_Geojson, 'w', driver='GeoJSON', crs='EPSG:4326', schema=schema) as out:
+		for json in files_json:
+			with fiona.open(json) as src:
+				for feat in src:
+					geom = transform_geom(src.crs, 'EPSG:4326', feat['geometry'])
+					out.write({'geometry': geom, 'properties': feat['properties']})
 
 def jsVariable(multi_geojson,variable_js):
 	""" Convierte los datos Geojson y los convierte en una variable JavaScript, necesaria para la lectura
@@ -116,22 +152,24 @@ def geojsonShapefile(multi_geojson):
 	df = gpd.read_file(multi_geojson)
 	df.to_file("data_multiShapefile/afai_multi.shp", driver="ESRI Shapefile")
 
-path_TarGZ = './data_TarGZ/*'
+if __name__ == '__main__':
+
+	path_TarGZ = './data_TarGZ/*'
 
-for file in glob(path_TarGZ):
+	for file in glob(path_TarGZ):
 
-	print(file)
-	dia = file.split('/')[-1].split('.')[0]
-	print(dia)
+		print(file)
+		dia = file.split('/')[-1].split('.')[0]
+		print(dia)
 
-	path_GeoTIFF = './data_GeoTIFF/'+dia+'/'
-	path_Shapefile = './data_Shapefile/'+dia+'/'
-	path_Geojson = './data_Geojson/'+dia+'/'
-	multi_Geojson = 'multi_Geojson.json'
+		path_GeoTIFF = './data_GeoTIFF/'+dia+'/'
+		path_Shapefile = './data_Shapefile/'+dia+'/'
+		path_Geojson = './data_Geojson/'+dia+'/'
+		multi_Geojson = 'multi_Geojson.json'
 
-	geotiffTogeojson(path_GeoTIFF,path_Geojson,path_Shapefile)
+		geotiffTogeojson(path_GeoTIFF,path_Geojson,path_Shapefile)
 
-variable_js = 'animacion.js'
-multiGeojson(path_Geojson,multi_Geojson)
-jsVariable(multi_Geojson,variable_js)
-#geojsonShapefile(multi_Geojson)
+	variable_js = 'animacion.js'
+	multiGeojson(path_Geojson,multi_Geojson)
+	jsVariable(multi_Geojson,variable_js)
+	#geojsonShapefile(multi_Geojson)
@@ -2,31 +2,94 @@
 
 # ==============================================================================
 
-import sys
+import argparse
 
 from ASI import ASI_Index
 
 # ==============================================================================
 # Program confgiruation
-# See ASI.py for further details
+# See ASI.py for further details. These are the defaults; all can be overriden
+# from the command line (run with --help)
 
 # Path to the training set
 train_set_path = ""
-#train_set_path = sys.argv[1]
 
-# Batch size used for training -- should not be large!
+# Batch size used for training -- should not be large! Set to "auto" to use
+# the largest that fits in the device memory
 batch_size = 32
 
+# Number of batches whose gradients are accumulated before each update; the
+# effective batch size is batch_size * grad_accum_steps
+grad_accum_steps = 1
+
 # Number of training epochs to use
 training_epochs = 10
 
 # Directory where the trained model is to be saved
 model_out_dir = "./"
 
+# Also save checkpoints of the model every this many epochs (None for none)
+checkpoint_epochs = None
+
+# Compile the training step with XLA?
+jit_compile = True
+
+# Number of training steps run per call into TensorFlow. This script uses 16
+# rather than train_model()'s default of 1, as several avoid the per-step
+# overhead that dominates with the small ASI network and batches; the cost is
+# that the progress bar and callbacks (including TensorBoard's batch-level
+# logs) are only updated every this many steps. Set to 1 for per-batch updates
+steps_per_execution = 16
+
+# Number of GPUs to train on (None for the default single device)
+num_gpus = None
+
+# Train with mixed float16/float32 precision? Speeds up training on GPUs with
+# Tensor Cores; slower on CPUs
+mixed_precision = False
+
+# Also save reduced-precision (float16 and int8) TensorFlow Lite versions of the
+# trained model, for deployment?
+export_tflite = False
+
 # ==============================================================================
 
-# Initialize the ASI class (without loading a model)
-ASI = ASI_Index()
+def _batch_size(value):
+  """Parses the --batch_size argument: a positive integer or "auto"."""
+  if value == "auto":
+    return value
+  return int(value)
+
+def _optional_int(value):
+  """Parses an integer argument that may also be "none"."""
+  if value.lower() == "none":
+    return None
+  return int(value)
+
+# ==============================================================================
+
+if __name__ == "__main__":
+
+  parser = argparse.ArgumentParser(description="Train a new ASI model from a pre-generated training set")
+  parser.add_argument("--train_set_path", default=train_set_path, help="path to the training set")
+  parser.add_argument("--batch_size", type=_batch_size, default=batch_size, help="batch size, or \"auto\" (default: %(default)s)")
+  parser.add_argument("--grad_accum_steps", type=int, default=grad_accum_steps, help="batches accumulated per update (default: %(default)s)")
+  parser.add_argument("--epochs", type=int, default=training_epochs, help="number of training epochs (default: %(default)s)")
+  parser.add_argument("--out_dir", default=model_out_dir, help="directory where the model is saved (default: %(default)s)")
+  parser.add_argument("--checkpoint_epochs", type=_optional_int, default=checkpoint_epochs, help="save a checkpoint every this many epochs, or \"none\" (default: %(default)s)")
+  parser.add_argument("--jit", action=argparse.BooleanOptionalAction, default=jit_compile, help="compile the training step with XLA (default: %(default)s)")
+  parser.add_argument("--steps_per_execution", type=int, default=steps_per_execution, help="training steps per call into TensorFlow; progress and callbacks are updated once per call (default: %(default)s, vs. 1 in train_model())")
+  parser.add_argument("--num_gpus", type=_optional_int, default=num_gpus, help="number of GPUs to train on, or \"none\" (default: %(default)s)")
+  parser.add_argument("--mixed_precision", action=argparse.BooleanOptionalAction, default=mixed_precision, help="train with mixed float16/float32 precision (default: %(default)s)")
+  parser.add_argument("--tflite", action=argparse.BooleanOptionalAction, default=export_tflite, help="also save float16 and int8 TensorFlow Lite models (default: %(default)s)")
+  args = parser.parse_args()
+
+  # Initialize the ASI class (without loading a model)
+  ASI = ASI_Index()
+
+  # Train ASi using the given training set
+  model = ASI.train_model(args.train_set_path, model_out_dir=args.out_dir, batch_size=args.batch_size, training_epochs=args.epochs, mixed_precision=args.mixed_precision, grad_accum_steps=args.grad_accum_steps, num_gpus=args.num_gpus, jit_compile=args.jit, steps_per_execution=args.steps_per_execution, checkpoint_epochs=args.checkpoint_epochs)
 
-# Train ASi using the given training set
-model = ASI.train_model(train_set_path, model_out_dir=model_out_dir, batch_size=batch_size, training_epochs=training_epochs)
+  # Save quantized versions of the model for deployment
+  if args.tflite:
+    ASI.export_tflite(model, args.train_set_path, out_dir=args.out_dir)